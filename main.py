@@ -5,10 +5,8 @@ import collections
 
 from twisted.python import log
 from twisted.application import service
-from twisted.application.internet import TCPClient, TCPServer
-from twisted.internet import task
+from twisted.application.internet import TCPServer
 from twisted.internet import reactor, threads
-from twisted.internet.defer import Deferred
 from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
 
 from pllm import manhole, interpret
@@ -16,12 +14,13 @@ from pllm import backends, config, monitor, util
 from pllm.vision import process, algo
 from pllm.vision.protocol import VisionClientProtocol
 
-from pllm.vnc.vnc import VNCFactory
+from pllm.vnc.damage import intersects
+from pllm.vnc.hub import VNCHub
 
 
 trace = util.trace
 
-CAP_DELAY = 1.5
+CAP_DELAY = 0.5
 
 
 class Pllm(object):
@@ -33,6 +32,7 @@ class Pllm(object):
         super(Pllm, self).__init__()
 
         self.vnc = None
+        self.hub = None
         self.int = None
         self.dom = None
         self.mon = None
@@ -51,6 +51,13 @@ class Pllm(object):
         self.work_dir = config.get('work_dir')
         self.state = 'INIT'
 
+        # screen updates are paused while more vision tasks
+        # are pending or more screens are being written
+        self.vision_backlog = config.get('vision_backlog', 4)
+        self.write_backlog = config.get('write_backlog', 1)
+        self.writing = 0
+        self.postponed_save = None
+
     def main(self):
         prev_state = self.state
 
@@ -114,23 +121,46 @@ class Pllm(object):
             self.dom.start()
 
     def start_vnc(self):
-        vnc_factory = VNCFactory()
+        if not self.hub:
+            self.hub = VNCHub()
+            self.hub.setServiceParent(self.app)
+
+        if self.dom_ident in self.hub.factories:
+            # still connecting
+            return
+
+        vnc_factory = self.hub.add(self.dom_ident,
+                                   config.get('vnc_host', 'localhost'),
+                                   config.get('vnc_port', 5900))
         vnc_factory.connected_callback = self.vnc_started
         vnc_factory.disconnected_callback = self.vnc_stopped
-        vnc_service = TCPClient("localhost", 5900, vnc_factory)
-        vnc_service.setServiceParent(self.app)
+        vnc_factory.resized_callback = self.vnc_resized
+        vnc_factory.synced_callback = self.vnc_synced
 
     @trace
     def vnc_stopped(self):
-        self.vnc_loop.stop()
+        self.emit('VNC_STOPPED')
+        # capture loop is restarted with the next connection
+        self.vnc = None
+        self.postponed_save = None
+
+    @trace
+    def vnc_synced(self, proto, stats):
+        self.emit('VNC_SYNCED', stats)
+
+    @trace
+    def vnc_resized(self, proto):
+        self.emit('VNC_RESIZED', (proto.width, proto.height))
 
     @trace
     def vnc_started(self, proto):
         self.vnc = proto
         self.dom.transport = proto
+        self.dom.frames = proto.frames
 
-        self.vnc_loop = task.LoopingCall(proto.framebufferUpdateRequest)
-        self.vnc_loop.start(5.0)
+        # updates are driven by the protocol itself, either pushed
+        # by the server (continuous updates) or requested incrementally
+        # after each one is received
         self.schedule_save(proto)
 
     @trace
@@ -162,9 +192,31 @@ class Pllm(object):
     def emit(self, msg, data=None):
         self.mon.emit(msg, data)
 
+    def busy(self):
+        pending = self.vision.pending() if self.vision else 0
+        return (pending >= self.vision_backlog or
+                self.writing >= self.write_backlog)
+
+    def check_backlog(self, result=None):
+        """ Capture postponed screen once consumers caught up """
+        if self.postponed_save and not self.busy():
+            proto, self.postponed_save = self.postponed_save, None
+            self.emit('BACKPRESSURE', False)
+            proto.resume_updates()
+            # changes held back by the server only start arriving now,
+            # capture once they settle; resuming counts as a change so
+            # the capture happens even if nothing changed meanwhile
+            proto.settle.update([])
+            self.schedule_save(proto)
+
+        return result
+
     #@trace
     def store_ocr_full(self, result, ident):
         log.msg('vis: full result for {0}'.format(ident))
+        if result is None:
+            return
+
         with self.dom.screen_lock:
             if self.dom.screen_id > ident:
                 if not self.dom.allow_outdated_results:
@@ -176,13 +228,21 @@ class Pllm(object):
     #@trace
     def store_ocr_segments(self, result, ident):
         log.msg('vis: segments result for {0}'.format(ident))
+        if result is None:
+            return
+
         with self.dom.screen_lock:
             if self.dom.screen_id > ident:
                 log.msg('outdated, discarding')
                 return
 
+            # result covers only damaged areas, merge with segments
+            # retained from previous screens
+            segments = dict(self.dom.segments)
+            segments.update(result)
             self.dom.segments = collections.OrderedDict(
-                sorted(result.items(), key=lambda item: len(item[0])))
+                sorted(segments.items(), key=lambda item: len(item[0])))
+            self.dom.ocr_damage.take()
 
     @trace
     def store_ocr_results(self, result, ident):
@@ -205,9 +265,33 @@ class Pllm(object):
 
     #@trace
     def save_screen(self, proto):
+        if proto is not self.vnc:
+            # connection was lost meanwhile
+            return
+
+        self.emit('SETTLE', proto.settle.last)
+
+        if self.busy():
+            # stop updates until consumers catch up, check_backlog
+            # resumes them and captures the screen once the changes
+            # made meanwhile arrive
+            self.emit('BACKPRESSURE', True)
+            self.postponed_save = proto
+            proto.pause_updates()
+            return
+
         with self.dom.screen_lock:
-            similar = algo.similar(self.dom.screen, proto.screen)
+            damage = proto.damage.take()
+            if self.dom.screen is not None and not damage:
+                # nothing changed since the last capture
+                similar = True
+            else:
+                similar = algo.similar(self.dom.screen, proto.screen,
+                                       rects=damage)
             if similar:
+                # keep small changes until they add up
+                proto.damage.extend(damage)
+
                 self.dom.similar_counter += 1
                 if self.dom.similar_counter >= 3:
                     if not self.dom.ocr_enabled:
@@ -217,43 +301,75 @@ class Pllm(object):
 
                 #print('Similar images, skipping')
                 self.emit('SIMILAR')
-                reactor.callLater(CAP_DELAY, self.schedule_save, proto)
             else:
                 log.msg("Screen #{0}".format(self.dom.screen_id + 1))
                 self.dom.similar_counter = 0
 
-                self.dom.screen = proto.screen.copy()
-                screendir = os.path.join(self.work_dir,
-                                         '{0:03d}'.format(self.dom.screen_id))
+                # no damage here means we have no previous screen
+                frame = proto.frames.snapshot(proto.screen, damage or None)
+                self.dom.frame = frame
+                self.dom.screen = frame.image
+                self.dom.damage = damage
+
+                # screens still being written take the previous ids
+                index = self.dom.screen_id + self.writing
+                self.writing += 1
+                d = threads.deferToThread(self.write_screen, proto, frame,
+                                          index)
+                d.addCallback(self.screen_written, index, damage)
+                d.addErrback(log.err)
+                d.addBoth(self.finish_write)
 
-                if os.path.isdir(screendir):
-                    shutil.rmtree(screendir)
+                self.emit('SCHEDULE_SAVE_DELAY', CAP_DELAY)
 
-                os.mkdir(screendir)
+            reactor.callLater(CAP_DELAY, self.schedule_save, proto)
 
-                fpath = os.path.join(screendir, "screen.png")
-                cpath = os.path.join(self.work_dir, "last.png")
+    def write_screen(self, proto, frame, index):
+        """ Write `frame` to screen directory `index`, runs in a thread """
+        screendir = os.path.join(self.work_dir, '{0:03d}'.format(index))
 
-                proto.save_screen(fpath)
-                proto.save_screen(cpath)
+        if os.path.isdir(screendir):
+            shutil.rmtree(screendir)
 
-                self.dom.screen_id += 1
-                self.dom.screen_path = fpath
+        os.mkdir(screendir)
 
-                self.dom.text = ""
-                self.dom.segments = {}
+        fpath = os.path.join(screendir, "screen.png")
+        cpath = os.path.join(self.work_dir, "last.png")
 
-                if self.dom.ocr_enabled:
-                    self.start_ocr_tasks()
+        proto.save_screen(fpath, frame.image)
+        proto.save_screen(cpath, frame.image)
 
-                self.emit('SCREEN_ID', self.dom.screen_id)
-                self.emit('SCREEN_DIR', screendir)
-                self.emit('SCREEN_STORED', fpath)
-                self.emit('SCREEN_CURRENT', cpath)
+        return screendir, fpath, cpath
 
-                self.emit('SCHEDULE_SAVE_DELAY', CAP_DELAY)
+    def screen_written(self, paths, index, damage):
+        screendir, fpath, cpath = paths
 
-            reactor.callLater(CAP_DELAY, self.schedule_save, proto)
+        with self.dom.screen_lock:
+            self.dom.ocr_damage.extend(damage)
+            if index < self.dom.screen_id:
+                # newer screen finished first
+                return
+
+            self.dom.screen_id = index + 1
+            self.dom.screen_path = fpath
+
+            self.dom.text = ""
+            # segments outside of damaged areas are still valid
+            self.dom.segments = collections.OrderedDict(
+                (text, data) for text, data in self.dom.segments.items()
+                if not any(intersects(data[0], rect) for rect in damage))
+
+            if self.dom.ocr_enabled:
+                self.start_ocr_tasks()
+
+        self.emit('SCREEN_ID', self.dom.screen_id)
+        self.emit('SCREEN_DIR', screendir)
+        self.emit('SCREEN_STORED', fpath)
+        self.emit('SCREEN_CURRENT', cpath)
+
+    def finish_write(self, result):
+        self.writing -= 1
+        return self.check_backlog(result)
 
     def start_ocr_tasks(self):
         fpath = self.dom.screen_path
@@ -262,17 +378,22 @@ class Pllm(object):
         full_task = self.vision.process_task(
             "ocr_full", counter, 0, [fpath])
         full_task.addCallback(self.store_ocr_full, counter)
+        full_task.addBoth(self.check_backlog)
 
         segments_task = self.vision.process_task(
-            "ocr_segments", counter, 0, [fpath])
+            "ocr_segments", counter, 0, [fpath, list(self.dom.ocr_damage)])
         segments_task.addCallback(self.store_ocr_segments, counter)
+        segments_task.addBoth(self.check_backlog)
 
     #@trace
     def schedule_save(self, proto):
+        if proto is not self.vnc:
+            return
+
         self.emit('SCHEDULE_SAVE')
 
-        proto.deferred = Deferred()
-        proto.deferred.addCallback(self.save_screen)
+        d = proto.wait_settled()
+        d.addCallback(self.save_screen)
 
     @trace
     def start_interpret(self):
@@ -19,11 +19,11 @@ def config_parser():
     return config
 
 
-def get(key):
+def get(key, default=None):
     if key in CONFIG:
         return CONFIG[key]
 
-    return None
+    return default
 
 
 def load():
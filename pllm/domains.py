@@ -1,23 +1,48 @@
 import threading
+import collections
 
 import time
 import libvirt
 from twisted.python import log
+from twisted.internet import reactor, defer
 
 import util
+from pllm.vnc.damage import DamageRegion
 
 
 class Domain(object):
+    # seconds to wait for the server to acknowledge input
+    sync_timeout = 2.0
+
     def __init__(self):
         self.screen = None
         self.screen_id = 0
+        # current frame and history of frames of the screen
+        self.frame = None
+        self.frames = None
         self.screen_lock = threading.RLock()
         self.transport = None
 
+        # areas changed against the previous screen and areas
+        # changed since the last finished segments OCR
+        self.damage = []
+        self.ocr_damage = DamageRegion()
+
         self.ocr_enabled = True
+        # guest picks up ClientCutText, needs a clipboard agent in the
+        # guest (stock QEMU VNC has none), nothing confirms the paste so
+        # enable only for guests known to have one
+        self.clipboard_enabled = False
+        self.paste_chord = 'ctrl`v'
+        # input acknowledgement round trip times
+        self.sync_latency = collections.deque(maxlen=100)
+        self.sync_timeouts = 0
         self.allow_outdated_results = False
         self.similar_counter = 0
 
+        # scales templates were last found at on this domain's screens
+        self.template_scales = {}
+
         self.result_lock = threading.RLock()
         self.text = ''
         self.segments = {}
@@ -36,10 +61,106 @@ class Domain(object):
         raise NotImplementedError
 
     # shortcuts
-    def write(self, keys):
+    def write(self, keys, mode='keys'):
+        """ Type `keys`, mode='clipboard' pastes them at once
+            when possible """
+        if mode == 'clipboard' and self.paste(keys):
+            return
+
         for key in keys:
             self.key_press(key)
-            time.sleep(0.2)
+            # wait for the server instead of guessing a delay
+            self.sync()
+
+    def paste(self, text, chord=None):
+        """ Push `text` to the guest clipboard and press paste `chord`,
+            return False if the text can't be sent this way """
+        if not self.clipboard_enabled:
+            return False
+
+        try:
+            # ClientCutText is Latin-1 only
+            message = text.encode('latin-1')
+        except UnicodeError:
+            return False
+
+        self.trans('clientCutText', message)
+        self.key_press(chord or self.paste_chord)
+        self.sync()
+        return True
+
+    def sync(self, timeout=None):
+        """ Block until the server processed all input sent so far,
+            return False if it didn't within `timeout` seconds """
+        if timeout is None:
+            timeout = self.sync_timeout
+
+        started = time.time()
+        done, acked = self._call('sync', timeout)
+        # transport gives up after `timeout` itself, this guards
+        # against the reactor not running the call at all
+        if not done.wait(timeout + self.sync_timeout):
+            acked = [None]
+
+        if not acked:
+            return False
+
+        if acked[0] is None:
+            self.sync_timeouts += 1
+            log.msg('sync not acknowledged within {0}s'.format(timeout))
+            return False
+
+        self.sync_latency.append(time.time() - started)
+        return True
+
+    def read_clipboard(self, select=True, timeout=None):
+        """ Copy text of the focused widget through the guest clipboard,
+            everything if `select` is set. Much faster than OCR for text
+            widgets, returns None if no text arrived within `timeout`
+            seconds """
+        if timeout is None:
+            timeout = self.sync_timeout
+
+        done, text = self._call('read_clipboard', select, timeout)
+        # transport gives up after `timeout` itself, this guards
+        # against the reactor not running the call at all
+        if (not done.wait(timeout + self.sync_timeout) or not text or
+                text[0] is None):
+            log.msg('no clipboard text within {0}s'.format(timeout))
+            return None
+
+        return text[0]
+
+    def _call(self, method, *args):
+        """ Call transport `method` returning Deferred in the reactor
+            thread. Returns (event, result), event is set once
+            the Deferred fires, result list holds its value
+            unless it failed """
+        done = threading.Event()
+        result = []
+
+        def start():
+            d = defer.maybeDeferred(self.trans, method, *args)
+            d.addCallbacks(result.append, log.err)
+            d.addBoth(lambda _: done.set())
+
+        reactor.callFromThread(start)
+        return done, result
+
+    def sync_stats(self):
+        """
+        Return summary of input acknowledgement latencies
+        """
+
+        if not self.sync_latency:
+            return {'count': 0, 'timeouts': self.sync_timeouts}
+
+        return {
+            'count': len(self.sync_latency),
+            'mean': sum(self.sync_latency) / len(self.sync_latency),
+            'max': max(self.sync_latency),
+            'timeouts': self.sync_timeouts,
+        }
 
     def click(self):
         self.mouse_press(1)
@@ -66,23 +187,23 @@ class Domain(object):
 
     def key_down(self, key):
         self.trans('key_down', key)
-        time.sleep(0.1)
+        self.sync()
 
     def key_up(self, key):
         self.trans('key_up', key)
-        time.sleep(0.1)
+        self.sync()
 
     def mouse_press(self, button):
         self.trans('mouse_press', button)
-        time.sleep(0.1)
+        self.sync()
 
     def mouse_down(self, button):
         self.trans('mouse_down', button)
-        time.sleep(0.1)
+        self.sync()
 
     def mouse_up(self, button):
         self.trans('mouse_up', button)
-        time.sleep(0.1)
+        self.sync()
 
     def mouse_move(self, x, y):
         self.trans('mouse_move', x, y)
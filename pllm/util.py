@@ -2,7 +2,6 @@ import os
 import base64
 import cPickle as pickle
 
-import cv2
 import libvirt
 from twisted.python import log
 
@@ -33,10 +32,6 @@ def template_path(name):
     return '{0}/{1}.png'.format(config.CONFIG['template_dir'], name)
 
 
-def load_img(name):
-    return cv2.imread(template_path(name))
-
-
 def encdata(data):
     return base64.b64encode(pickle.dumps(data))
 
@@ -159,10 +159,13 @@ def same(a, b):
     return not any(cv2.sumElems(cv2.absdiff(a, b)))
 
 
-def similar(a, b, max_differ=200):
+def similar(a, b, max_differ=200, rects=None):
     """
     Return True if img `a` differs from `b`
     only in `max_differ` pixels
+
+    If list of (x, y, w, h) `rects` is given only these
+    (non-overlapping) areas are compared
     """
 
     if a is None or b is None:
@@ -171,8 +174,16 @@ def similar(a, b, max_differ=200):
     if a.shape != b.shape:
         return False
 
-    cc = cv2.compare(gray(a), gray(b), cv2.CMP_NE)
-    diff = cv2.countNonZero(cc)
+    if rects is None:
+        h, w = a.shape[:2]
+        rects = [(0, 0, w, h)]
+
+    diff = 0
+    for (x, y, w, h) in rects:
+        ra = a[y:y + h, x:x + w]
+        rb = b[y:y + h, x:x + w]
+        cc = cv2.compare(gray(ra), gray(rb), cv2.CMP_NE)
+        diff += cv2.countNonZero(cc)
     #print("Differs {0}".format(diff))
     return  diff < max_differ
 
@@ -206,16 +217,199 @@ def mser_segments(img, delta=3,
     return segs
 
 
-def template_match(target, template):
+def template_match(target, template, levels=0, min_size=16, candidates=5,
+                   mask=None, template_pyramid=None, target_pyramid=None):
     """
     Match template against target
+
+    With `levels` the match is done on images downscaled `levels` times
+    by half first, template is kept at least `min_size` pixels on each
+    side. Best `candidates` locations found are then matched again at
+    full resolution in their neighbourhood only.
+
+    Pixels of `template` where `mask` is zero are ignored, scores stay
+    those of TM_CCOEFF_NORMED computed over the other pixels (see
+    `match`). Precomputed `template_pyramid` and `target_pyramid`
+    (see `pyramid`) save downscaling on every call.
+
+    Returns (max_val, x, y) of the best match, x, y pointing to its center,
+    max_val is -1 for templates larger than target
     """
 
     h, w, d = template.shape
+    if h > target.shape[0] or w > target.shape[1]:
+        # e.g. template scaled up for a screen larger than this one
+        return -1.0, 0, 0
+
+    levels = min(levels, pyramid_levels(template, min_size))
+    if levels <= 0:
+        res = match(target, template, mask)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+        return max_val, max_loc[0] + w / 2, max_loc[1] + h / 2
+
+    if template_pyramid is None or len(template_pyramid) < levels:
+        template_pyramid = pyramid(template, levels, mask)
+
+    if target_pyramid is None or len(target_pyramid) < levels:
+        target_pyramid = pyramid(target, levels)
+
+    small_target = target_pyramid[levels - 1][0]
+    small_template, small_mask = template_pyramid[levels - 1]
+
+    res = match(small_target, small_template, small_mask)
+
+    # coarse location is off by a pixel or so of its level
+    scale = 2 ** levels
+    margin = 2 * scale
+    th, tw = target.shape[:2]
+
+    best = (-1.0, 0, 0)
+    for cx, cy in peaks(res, small_template.shape, candidates):
+        x0 = max(0, cx * scale - margin)
+        y0 = max(0, cy * scale - margin)
+        x1 = min(tw, cx * scale + margin + w)
+        y1 = min(th, cy * scale + margin + h)
+
+        window = match(target[y0:y1, x0:x1], template, mask)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(window)
+        if max_val > best[0]:
+            best = (max_val, x0 + max_loc[0] + w / 2, y0 + max_loc[1] + h / 2)
+
+    return best
+
+
+def match_many(target, templates, levels=0, min_size=16, candidates=5,
+               pool=None):
+    """
+    Match list of (template, mask, template_pyramid) `templates` against
+    target, mask and pyramid may be None. Target is downscaled only once
+    for all of them, matching runs in thread `pool` if given.
+
+    Returns list of (max_val, x, y) as `template_match` does
+    """
+
+    if levels > 0 and templates:
+        levels = min(levels, max(pyramid_levels(t[0], min_size)
+                                 for t in templates))
+    target_pyramid = pyramid(target, levels) if levels > 0 else None
+
+    def run(args):
+        template, mask, template_pyramid = args
+        return template_match(target, template, levels, min_size,
+                              candidates, mask, template_pyramid,
+                              target_pyramid)
+
+    if pool is None:
+        return map(run, templates)
+
+    return pool.map(run, templates)
+
+
+def match(target, template, mask=None):
+    """
+    TM_CCOEFF_NORMED result of matching template against target,
+    only pixels where `mask` is non-zero count if given.
+
+    OpenCV has no masked TM_CCOEFF_NORMED (and TM_CCORR_NORMED it
+    supports masks for scores any flat bright area high), masked
+    version is put together from plain correlations instead.
+    """
+
+    if mask is None:
+        return cv2.matchTemplate(target, template, cv2.TM_CCOEFF_NORMED)
+
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    weights = (mask > 0).astype(np.float32)
+    count = max(weights.sum(), 1)
+
+    target = target.astype(np.float32)
+    template = template.astype(np.float32)
+
+    # template centered on its mean under the mask, zero elsewhere
+    centered = np.empty_like(template)
+    template_var = 0
+    for c in range(template.shape[2]):
+        channel = template[:, :, c]
+        mean = (channel * weights).sum() / count
+        centered[:, :, c] = (channel - mean) * weights
+        template_var += (centered[:, :, c] ** 2).sum()
+
+    # sum over channels of (target - its mean under the mask) * template
+    # equals the plain correlation as centered template sums to zero
+    cross = cv2.matchTemplate(target, centered, cv2.TM_CCORR)
+
+    target_var = np.zeros(cross.shape, dtype=np.float32)
+    for c in range(target.shape[2]):
+        channel = np.ascontiguousarray(target[:, :, c])
+        sums = cv2.matchTemplate(channel, weights, cv2.TM_CCORR)
+        squares = cv2.matchTemplate(channel * channel, weights,
+                                    cv2.TM_CCORR)
+        target_var += squares - sums * sums / count
+
+    denominator = np.sqrt(np.maximum(target_var, 0) * template_var)
+    # flat areas (or flat template) correlate with nothing
+    flat = denominator < 1e-3 * count
+    denominator[flat] = 1
+    res = cross / denominator
+    res[flat] = 0
+    return np.clip(res, -1, 1)
+
+
+def pyramid(img, levels, mask=None):
+    """
+    Return list of (img, mask) tuples of `img` halved 1 to `levels` times,
+    only pixels fully inside `mask` stay unmasked
+    """
+
+    result = []
+    for _ in range(levels):
+        img = cv2.pyrDown(img)
+        if mask is not None:
+            mask = cv2.pyrDown(mask)
+            mask[mask < 255] = 0
+        result.append((img, mask))
+
+    return result
+
+
+def pyramid_levels(template, min_size=16):
+    """
+    Number of times `template` can be halved keeping
+    both sides at least `min_size` pixels
+    """
+
+    side = min(template.shape[:2])
+    levels = 0
+    while side // 2 >= min_size:
+        side //= 2
+        levels += 1
+
+    return levels
+
+
+def peaks(res, template_shape, count):
+    """
+    Return (x, y) locations of `count` best matches in `res`,
+    suppressing matches overlapping better ones
+    """
+
+    res = res.copy()
+    h, w = template_shape[:2]
+    rh, rw = res.shape
+
+    found = []
+    for _ in range(count):
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+        if found and max_val < -0.5:
+            break
+
+        x, y = max_loc
+        found.append((x, y))
+        res[max(0, y - h // 2):min(rh, y + h // 2 + 1),
+            max(0, x - w // 2):min(rw, x + w // 2 + 1)] = -1.0
 
-    res = cv2.matchTemplate(target, template, cv2.TM_CCOEFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-    return max_val, max_loc[0] + w / 2, max_loc[1] + h / 2
+    return found
 
 
 def ocr_optimize(img, upscale=5, threshold=160, blur_kernel_size=4):
@@ -0,0 +1,165 @@
+"""
+In-memory catalog of templates.
+
+Templates are read from `template_dir` once along with pyramids used
+for matching, lookups only check the file has not changed since.
+The catalog is shared by all threads of the process, least recently
+used templates are dropped once it grows over its size limit.
+
+Templates resized for screens of different scale are kept as separate
+entries of the catalog.
+"""
+
+import os
+import threading
+import collections
+
+import cv2
+import numpy as np
+
+from pllm import config, util
+from pllm.vision import algo
+
+
+class Template(object):
+    """
+    Template `image` (BGR) loaded from `path` and resized by `scale`
+    with `mask` of opaque pixels (None without alpha channel) and
+    `pyramid` of downscaled (image, mask) levels
+    """
+
+    def __init__(self, name, path, mtime, image, alpha=None,
+                 levels=0, min_size=16, scale=1.0):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.scale = scale
+        self.image = image
+
+        self.mask = None
+        if alpha is not None and (alpha < 255).any():
+            opaque = np.where(alpha == 255, 255, 0).astype(np.uint8)
+            self.mask = cv2.merge([opaque] * 3)
+
+        levels = min(levels, algo.pyramid_levels(image, min_size))
+        self.pyramid = algo.pyramid(image, levels, self.mask)
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def nbytes(self):
+        arrays = [self.image, self.mask]
+        for level in self.pyramid:
+            arrays.extend(level)
+
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def __repr__(self):
+        return '<Template {0} {1}x{2} scale={3}>'.format(
+            self.name, self.shape[1], self.shape[0], self.scale)
+
+
+class TemplateCatalog(object):
+    """
+    Templates by name, using at most `max_bytes` of memory,
+    with pyramids of up to `levels` levels
+    """
+
+    def __init__(self, max_bytes=64 << 20, levels=0, min_size=16):
+        self.max_bytes = max_bytes
+        self.levels = levels
+        self.min_size = min_size
+
+        self.templates = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, name, scale=1.0):
+        """
+        Return Template `name` resized by `scale`, reloaded if its file
+        changed, raises IOError when it can't be read
+        """
+
+        path = util.template_path(name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            raise IOError('Unable to read template {0}'.format(path))
+
+        key = (name, scale)
+        with self.lock:
+            template = self.templates.pop(key, None)
+            if template is not None:
+                self.size -= template.nbytes
+                if template.mtime != mtime:
+                    template = None
+
+            if template is None:
+                template = self.load(name, path, mtime, scale)
+                self.loads += 1
+            else:
+                self.hits += 1
+
+            # most recently used are kept last
+            self.templates[key] = template
+            self.size += template.nbytes
+            self.evict()
+
+        return template
+
+    def load(self, name, path, mtime, scale=1.0):
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise IOError('Unable to read template {0}'.format(path))
+
+        if scale != 1.0:
+            interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+            img = cv2.resize(img, None, fx=scale, fy=scale,
+                             interpolation=interpolation)
+
+        alpha = None
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        elif img.shape[2] == 4:
+            alpha = np.ascontiguousarray(img[:, :, 3])
+            img = np.ascontiguousarray(img[:, :, :3])
+
+        return Template(name, path, mtime, img, alpha,
+                        self.levels, self.min_size, scale)
+
+    def evict(self):
+        # keep at least the template just used
+        while self.size > self.max_bytes and len(self.templates) > 1:
+            key, template = self.templates.popitem(last=False)
+            self.size -= template.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.size = 0
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def catalog():
+    """
+    Return TemplateCatalog of the process configured
+    by `template_*` options
+    """
+
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = TemplateCatalog(
+                max_bytes=config.get('template_cache_size', 64) << 20,
+                levels=config.get('template_pyramid_levels', 0),
+                min_size=config.get('template_min_size', 16))
+
+    return _catalog
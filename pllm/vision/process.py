@@ -54,8 +54,17 @@ class VisionPipeline(object):
             if j.ident < ident:
                 j.obsolete = True
 
+        # obsolete jobs waiting in the queue are never run,
+        # let the client know they are gone
+        for j in self.q:
+            if j.obsolete and not j.running:
+                j.d.callback((j.task_name, j.ident, None))
+
+        self.q = [j for j in self.q if j.running or not j.obsolete]
+
         job = Job(task_name, ident, priority, args)
         self.q.append(job)
+        self.maybe_run_task()
         return job.d
 
     def maybe_run_task(self):
@@ -74,12 +83,16 @@ class VisionPipeline(object):
 
     def done(self, job):
         self.running -= 1
+        self.q.remove(job)
         print("Done {0}".format(job))
-        if job.result is not None:
-            job.d.callback((job.task_name, job.ident, job.result))
-        else:
+        if job.result is None:
             print("Task did not return any result")
 
+        # client counts pending tasks, reply even without result
+        job.d.callback((job.task_name, job.ident, job.result))
+
+        self.maybe_run_task()
+
     def process_task(self, job):
         d = threads.deferToThread(job.run)
         d.addCallback(self.done)
@@ -16,17 +16,23 @@ class VisionClientProtocol(LineReceiver):
         dec = dec[1]
         task_name, ident, result = dec
 
-        self.identmap["{0}_{1}".format(task_name, ident)].callback(result)
+        d = self.identmap.pop((task_name, ident), None)
+        if d:
+            d.callback(result)
 
     def process_task(self, task_name, ident, priority, args):
         d = defer.Deferred()
-        self.identmap["{0}_{1}".format(task_name, ident)] = d
+        self.identmap[(task_name, ident)] = d
 
         enc = util.encdata((task_name, ident, priority, args))
         self.sendLine(enc)
 
         return d
 
+    def pending(self):
+        """ Number of tasks waiting for results """
+        return len(self.identmap)
+
 
 class VisionServerProtocol(LineReceiver):
     def connectionMade(self):
@@ -1,11 +1,15 @@
 import os
+import threading
 from operator import itemgetter
+from multiprocessing.pool import ThreadPool
 
 import cv2
 
-from pllm import config, util
+from pllm import config
 
+from pllm.vnc.damage import intersects
 from pllm.vision import algo
+from pllm.vision.catalog import catalog
 from pllm.vision.util import draw_segments, split_fpath
 from pllm.vision.ocr import ocr
 
@@ -15,12 +19,20 @@ def ocr_full(fpath):
     return txt
 
 
-def ocr_segments(fpath):
+def ocr_segments(fpath, damage=None):
+    """
+    OCR segments of `fpath` image, if list of damaged (x, y, w, h)
+    rectangles is given only segments intersecting them are processed
+    """
+
     segs = segmentize(fpath)
     segs_res = {}
 
     for segname, shape in segs.items():
-        x, y, w, h = shape
+        if damage is not None:
+            if not any(intersects(shape, rect) for rect in damage):
+                continue
+
         seg_ocr = ocr(segname)
         if seg_ocr:
             segs_res[seg_ocr] = (shape, segname)
@@ -168,37 +180,194 @@ def add_merged_close_segments(segments,
     return nsegs
 
 
-def template_match(target_fpath, template_name):
+def template_match(target_fpath, template_name, scales=None):
     """
     Match template_name image against target_fpath
 
+    With `scales` dict (see known_entry) the template is matched at
+    the scale it was found at on screens of this size, all
+    template_scales are searched when it wasn't found on such screen
+    yet. Callers keep one dict per domain.
+
     Returns (match_succes:bool, x:int, y:int)
 
     x, y pointing to center of the matched region
     """
 
     target = cv2.imread(target_fpath)
-    template = cv2.imread(util.template_path(template_name))
-    h, w, d = template.shape
 
     fdir, fname = os.path.split(target_fpath)
     #name = fname[:fname.rfind('.')]  # ext is .png
 
-    max_val, x, y = algo.template_match(target, template)
+    entry, search = known_entry(target, template_name, scales)
+    max_val, x, y = match_entry(target, entry)
 
-    scale_template = 1  # unused for now
-    if scale_template != 1:
-        template = cv2.resize(template, None,
-                              fx=scale_template,
-                              fy=scale_template,
-                              interpolation=cv2.INTER_CUBIC)
+    if search:
+        max_val, x, y, entry = match_scales(target, template_name, scales,
+                                            (max_val, x, y, entry))
 
     threshold = config.get('treshold')
     if max_val >= threshold:
-        cv2.rectangle(target, (x - w / 2, y - h / 2), (x + w / 2, y + h / 2),
-                      (0, 255, 0), 1)
-
-        cv2.imwrite("{0}/match_{1}.png".format(fdir, template_name),
-                    target)
+        h, w, d = entry.shape
+        save_match(target, fdir, template_name, x, y, w, h)
+        record_scale(scales, template_name, target, entry)
 
     return (max_val >= threshold, x, y)
+
+
+def match_many(target_fpath, template_names, scales=None):
+    """
+    Match all template_names images against target_fpath in one pass,
+    templates are matched in parallel, `scales` are used as by
+    template_match
+
+    Returns list of (match_succes:bool, x:int, y:int) in order
+    of template_names
+    """
+
+    target = cv2.imread(target_fpath)
+    entries = [known_entry(target, name, scales) for name in template_names]
+
+    fdir, fname = os.path.split(target_fpath)
+
+    scores = algo.match_many(
+        target, [(e.image, e.mask, e.pyramid) for e, search in entries],
+        levels=config.get('template_pyramid_levels', 0),
+        min_size=config.get('template_min_size', 16),
+        pool=match_pool())
+
+    threshold = config.get('treshold')
+    results = []
+    for name, (entry, search), score in zip(template_names, entries, scores):
+        max_val, x, y = score
+        if search:
+            max_val, x, y, entry = match_scales(target, name, scales,
+                                                (max_val, x, y, entry))
+
+        if max_val >= threshold:
+            h, w, d = entry.shape
+            save_match(target.copy(), fdir, name, x, y, w, h)
+            record_scale(scales, name, target, entry)
+
+        results.append((max_val >= threshold, x, y))
+
+    return results
+
+
+def known_entry(target, template_name, scales=None):
+    """
+    Return (entry, search), catalog entry of template_name at the scale
+    recorded in `scales` (1 if none) and whether other scales need to
+    be searched.
+
+    `scales` hold template_name: (scale, target shape, misses), misses
+    is None once the template was found on screens of that size.
+    Otherwise all scales were searched in vain and the search is
+    repeated every template_scale_retry matches, a template polled for
+    before it shows up mostly costs a single match.
+    """
+
+    if scales is None:
+        return catalog().get(template_name), False
+
+    scale, shape, misses = scales.get(template_name, (1.0, None, 0))
+    entry = catalog().get(template_name, scale)
+    if shape != target.shape:
+        return entry, True
+
+    if misses is None:
+        return entry, False
+
+    misses += 1
+    if misses < config.get('template_scale_retry', 10):
+        scales[template_name] = (scale, shape, misses)
+        return entry, False
+
+    return entry, True
+
+
+def record_scale(scales, template_name, target, entry):
+    """
+    Record scale of template `entry` found on `target`
+    """
+
+    if scales is not None:
+        scales[template_name] = (entry.scale, target.shape, None)
+
+
+def match_entry(target, entry):
+    """
+    Match catalog `entry` against target, returns (max_val, x, y)
+    """
+
+    return algo.template_match(
+        target, entry.image,
+        levels=config.get('template_pyramid_levels', 0),
+        min_size=config.get('template_min_size', 16),
+        mask=entry.mask, template_pyramid=entry.pyramid)
+
+
+def template_scales():
+    """
+    Scales of templates searched when screen size changes
+    """
+
+    value = config.get('template_scales', '0.5,0.75,1,1.25,1.5,2')
+    return [float(scale) for scale in str(value).split(',')]
+
+
+def match_scales(target, template_name, scales, best):
+    """
+    Search template_name at template_scales other than the one of
+    `best` (max_val, x, y, entry) result. Even a match at the recorded
+    scale does not stop the search, template scaled wrong may still
+    pass the threshold.
+
+    Failed search restarts the count of misses in `scales`, the scale
+    recorded before is kept
+
+    Returns the best (max_val, x, y, entry)
+    """
+
+    threshold = config.get('treshold')
+    tried = best[3]
+
+    for scale in template_scales():
+        if scale == tried.scale:
+            continue
+
+        entry = catalog().get(template_name, scale)
+        result = match_entry(target, entry) + (entry,)
+        if result[0] > best[0]:
+            best = result
+
+    if best[0] < threshold:
+        scales[template_name] = (tried.scale, target.shape, 0)
+
+    return best
+
+
+def save_match(target, fdir, template_name, x, y, w, h):
+    cv2.rectangle(target, (x - w / 2, y - h / 2), (x + w / 2, y + h / 2),
+                  (0, 255, 0), 1)
+
+    cv2.imwrite("{0}/match_{1}.png".format(fdir, template_name),
+                target)
+
+
+_match_pool = None
+_match_pool_lock = threading.Lock()
+
+
+def match_pool():
+    """
+    Thread pool for matching templates, cv2 releases the GIL
+    """
+
+    global _match_pool
+
+    with _match_pool_lock:
+        if _match_pool is None:
+            _match_pool = ThreadPool(config.get('template_threads', 4))
+
+    return _match_pool
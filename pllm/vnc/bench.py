@@ -0,0 +1,446 @@
+"""
+RFB decoder benchmark.
+
+Synthetic desktop screens are encoded into server streams which are
+fed to VNC.dataReceived in chunks of given size. Pixels are encoded in
+the little endian BGRX format VNC negotiates.
+
+Used by bin/rfb_bench.
+"""
+
+import time
+import zlib
+import resource
+from struct import pack
+
+import cv2
+import numpy as np
+
+import rfb
+import tight
+import zrle
+from vnc import VNC, VNCFactory
+
+ENCODINGS = ['raw', 'copyrect', 'rre', 'corre', 'hextile', 'zrle',
+             'tight', 'tight-jpeg']
+
+RESOLUTIONS = [(800, 600), (1024, 768), (1920, 1080), (3840, 2160)]
+
+# typical sizes of a TCP segment, socket read and large read
+CHUNKS = [1460, 16384, 65536]
+
+# size of rectangles the screen is split to, similar to what
+# servers send for each encoding
+RECT_SIZE = {
+    'raw': 256,
+    'copyrect': 256,
+    'rre': 64,
+    'corre': 64,
+    'hextile': 256,
+    'zrle': 256,
+    'tight': 128,
+    'tight-jpeg': 256,
+}
+
+
+# synthetic content
+
+def desktop(width, height, seed=0):
+    """
+    Return (height, width, 4) BGRX desktop-like screen with a panel,
+    windows full of text and a photo
+    """
+
+    rnd = np.random.RandomState(seed)
+    img = np.zeros((height, width, 4), dtype=np.uint8)
+
+    # wallpaper gradient and panel
+    img[:, :, 0] = np.linspace(200, 120, height)[:, None]
+    img[:, :, 1] = 110
+    img[:, :, 2] = 60
+    img[:24, :, :3] = 50
+
+    for i in range(4):
+        w = rnd.randint(width // 4, width // 2)
+        h = rnd.randint(height // 4, height // 2)
+        x = rnd.randint(0, width - w)
+        y = rnd.randint(24, height - h)
+
+        img[y:y + h, x:x + w, :3] = 240
+        img[y:y + 22, x:x + w, :3] = (200, 160, 120)
+        if i == 3:
+            photo(img[y + 22:y + h, x:x + w], rnd)
+        else:
+            text(img[y + 30:y + h - 8, x + 8:x + w - 8], rnd)
+
+    return img
+
+
+def text(area, rnd):
+    """ Fill `area` with lines of random 8x12 glyphs """
+    h, w = area.shape[:2]
+    rows, cols = h // 16, w // 8
+    if not rows or not cols:
+        return
+
+    glyphs = rnd.rand(64, 12, 8) < 0.3
+    glyphs[0] = False   # space
+    bits = glyphs[rnd.randint(0, 64, (rows, cols))]
+    bits = bits.transpose(0, 2, 1, 3).reshape((rows, 12, cols * 8))
+
+    mask = np.zeros((rows, 16, cols * 8), dtype=np.bool_)
+    mask[:, 2:14] = bits
+    mask = mask.reshape((rows * 16, cols * 8))
+    area[:rows * 16, :cols * 8][mask] = (30, 30, 30, 0)
+
+
+def photo(area, rnd):
+    """ Fill `area` with smooth noisy gradients """
+    h, w = area.shape[:2]
+    ys = np.linspace(0, 1, h)[:, None]
+    xs = np.linspace(0, 1, w)[None, :]
+    for channel, (a, b) in enumerate(rnd.rand(3, 2)):
+        smooth = 255 * (a * ys + b * xs) / (a + b)
+        noise = rnd.randint(-8, 8, (h, w))
+        area[:, :, channel] = np.clip(smooth + noise, 0, 255)
+
+
+# encoders
+
+def pixels32(img):
+    """ (h, w) array of BGRX pixels as little endian uint32 """
+    return np.ascontiguousarray(img).view('<u4')[:, :, 0]
+
+
+def runs(px):
+    """ Horizontal runs of equal pixels in (h, w) `px`,
+        returns (ys, xs, lengths, values) arrays """
+    h, w = px.shape
+    start = np.ones((h, w), dtype=np.bool_)
+    start[:, 1:] = px[:, 1:] != px[:, :-1]
+    ys, xs = np.nonzero(start)
+    # every row starts a run, so runs never cross rows
+    flat = ys * w + xs
+    lengths = np.append(flat[1:], h * w) - flat
+    return ys, xs, lengths, px[ys, xs]
+
+
+def background(px):
+    values, counts = np.unique(px, return_counts=True)
+    return values[np.argmax(counts)], len(values)
+
+
+def compact_length(length):
+    """ Tight compact representation of `length` """
+    out = bytearray()
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        if length:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def pack_indices(indices, bits):
+    """ Pack (h, w) palette `indices` to `bits` per pixel,
+        rows padded to byte boundary """
+    h, w = indices.shape
+    shifts = np.arange(bits - 1, -1, -1)
+    unpacked = (indices[:, :, None] >> shifts) & 1
+    return np.packbits(unpacked.reshape((h, w * bits)).astype(np.uint8),
+                       axis=1).tobytes()
+
+
+class Encoder(object):
+    """
+    Encode rectangles of `encoding`, keeps zlib streams
+    of the connection
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.zrle_stream = zlib.compressobj()
+        self.tight_streams = [zlib.compressobj() for _ in range(2)]
+
+    def rect(self, img, x, y, w, h):
+        """ Rectangle header and data for area of `img` """
+        area = img[y:y + h, x:x + w]
+        method = getattr(self, self.encoding.replace('-', '_'))
+        encoding, data = method(area)
+        return pack("!HHHHi", x, y, w, h, encoding) + data
+
+    def raw(self, area):
+        return rfb.RAW_ENCODING, np.ascontiguousarray(area).tobytes()
+
+    def _subrects(self, area, dtype):
+        px = pixels32(area)
+        bg, colors = background(px)
+        ys, xs, lengths, values = runs(px)
+        fg = values != bg
+
+        subrects = np.empty(fg.sum(), dtype=dtype)
+        subrects['p'] = values[fg]
+        subrects['x'] = xs[fg]
+        subrects['y'] = ys[fg]
+        subrects['w'] = lengths[fg]
+        subrects['h'] = 1
+        return (pack("!I", len(subrects)) + pack("<I", bg) +
+                subrects.tobytes())
+
+    def rre(self, area):
+        dtype = [('p', '<u4'), ('x', '>u2'), ('y', '>u2'),
+                 ('w', '>u2'), ('h', '>u2')]
+        return rfb.RRE_ENCODING, self._subrects(area, dtype)
+
+    def corre(self, area):
+        dtype = [('p', '<u4'), ('x', 'u1'), ('y', 'u1'),
+                 ('w', 'u1'), ('h', 'u1')]
+        return rfb.CORRE_ENCODING, self._subrects(area, dtype)
+
+    def hextile(self, area):
+        h, w = area.shape[:2]
+        out = []
+        for ty in range(0, h, 16):
+            for tx in range(0, w, 16):
+                out.append(self._hextile_tile(area[ty:ty + 16, tx:tx + 16]))
+
+        return rfb.HEXTILE_ENCODING, b''.join(out)
+
+    def _hextile_tile(self, tile):
+        th, tw = tile.shape[:2]
+        px = pixels32(tile)
+        bg, colors = background(px)
+        if colors == 1:
+            return pack("!B", 2) + pack("<I", bg)
+
+        ys, xs, lengths, values = runs(px)
+        fg = values != bg
+        count = fg.sum()
+        if count > 255 or count * 6 >= tw * th * 4:
+            return pack("!B", 1) + np.ascontiguousarray(tile).tobytes()
+
+        subrects = np.empty(count, dtype=[('p', '<u4'), ('xy', 'u1'),
+                                          ('wh', 'u1')])
+        subrects['p'] = values[fg]
+        subrects['xy'] = (xs[fg] << 4) | ys[fg]
+        subrects['wh'] = (lengths[fg] - 1) << 4
+        # background, any subrects, subrects coloured
+        return (pack("!B", 2 | 8 | 16) + pack("<I", bg) +
+                pack("!B", count) + subrects.tobytes())
+
+    def zrle(self, area):
+        h, w = area.shape[:2]
+        out = []
+        for ty in range(0, h, zrle.TILE_SIZE):
+            for tx in range(0, w, zrle.TILE_SIZE):
+                tile = area[ty:ty + zrle.TILE_SIZE, tx:tx + zrle.TILE_SIZE]
+                out.append(self._zrle_tile(tile))
+
+        data = self.zrle_stream.compress(b''.join(out))
+        data += self.zrle_stream.flush(zlib.Z_SYNC_FLUSH)
+        return rfb.ZRLE_ENCODING, pack("!I", len(data)) + data
+
+    def _zrle_tile(self, tile):
+        # CPIXEL is the B, G, R part of the pixel
+        px = pixels32(tile)
+        palette, indices = np.unique(px, return_inverse=True)
+        cpixels = palette.astype('<u4').view(np.uint8).reshape((-1, 4))
+        cpixels = cpixels[:, :3].tobytes()
+
+        if len(palette) == 1:
+            return pack("!B", 1) + cpixels
+
+        if len(palette) <= 16:
+            bits = 1 if len(palette) == 2 else 2 if len(palette) <= 4 else 4
+            indices = indices.reshape(px.shape)
+            return (pack("!B", len(palette)) + cpixels +
+                    pack_indices(indices, bits))
+
+        return pack("!B", 0) + np.ascontiguousarray(tile[:, :, :3]).tobytes()
+
+    def tight(self, area):
+        return self._tight(area)
+
+    def tight_jpeg(self, area):
+        return self._tight(area, jpeg=True)
+
+    def _tight(self, area, jpeg=False):
+        px = pixels32(area)
+        palette, indices = np.unique(px, return_inverse=True)
+        # TPIXEL is R, G, B
+        rgb = palette.astype('<u4').view(np.uint8).reshape((-1, 4))[:, 2::-1]
+
+        if len(palette) == 1:
+            return rfb.TIGHT_ENCODING, pack("!B", 0x80) + rgb.tobytes()
+
+        if len(palette) <= 16:
+            h, w = px.shape
+            indices = indices.reshape((h, w))
+            if len(palette) == 2:
+                data = pack_indices(indices, 1)
+            else:
+                data = indices.astype(np.uint8).tobytes()
+
+            # stream 1, explicit palette filter
+            header = (pack("!BBB", 0x50, tight.FILTER_PALETTE,
+                           len(palette) - 1) + rgb.tobytes())
+            return rfb.TIGHT_ENCODING, header + self._tight_data(data, 1)
+
+        if jpeg:
+            ok, data = cv2.imencode('.jpg', np.ascontiguousarray(area[:, :, :3]),
+                                    [cv2.IMWRITE_JPEG_QUALITY, 80])
+            data = data.tobytes()
+            return (rfb.TIGHT_ENCODING,
+                    pack("!B", 0x90) + compact_length(len(data)) + data)
+
+        data = np.ascontiguousarray(area[:, :, 2::-1]).tobytes()
+        return rfb.TIGHT_ENCODING, pack("!B", 0x00) + self._tight_data(data, 0)
+
+    def _tight_data(self, data, stream):
+        if len(data) < tight.MIN_TO_COMPRESS:
+            return data
+
+        compressor = self.tight_streams[stream]
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compact_length(len(data)) + data
+
+
+# streams
+
+def handshake(width, height):
+    """ Server side of RFB 3.3 handshake without authentication """
+    pixformat = pack("!BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255,
+                     16, 8, 0)
+    name = b'bench'
+    return (b'RFB 003.008\n' + pack("!I", 1) +
+            pack("!HH16sI", width, height, pixformat, len(name)) + name)
+
+
+def update(rects):
+    return pack("!BxH", 0, len(rects)) + b''.join(rects)
+
+
+def stream(encoding, width, height, frames=3, seed=0):
+    """
+    Return (prelude, body, rectangles, last screen) of a server stream,
+    body contains `frames` updates of the whole screen
+    """
+
+    encoder = Encoder(encoding)
+    size = RECT_SIZE[encoding]
+    prelude = handshake(width, height)
+    body = []
+    count = 0
+
+    if encoding == 'copyrect':
+        # scroll by a line of text, new line arrives raw
+        img = desktop(width, height, seed)
+        prelude += update(tile(Encoder('raw'), img, size))
+        for i in range(frames):
+            img = np.roll(img, -16, axis=0)
+            rects = [pack("!HHHHi", 0, 0, width, height - 16,
+                          rfb.COPY_RECTANGLE_ENCODING) + pack("!HH", 0, 16)]
+            rects += tile(Encoder('raw'), img, size, top=height - 16)
+            body.append(update(rects))
+            count += len(rects)
+
+        return prelude, b''.join(body), count, img
+
+    for i in range(frames):
+        img = desktop(width, height, seed + i)
+        rects = tile(encoder, img, size)
+        body.append(update(rects))
+        count += len(rects)
+
+    return prelude, b''.join(body), count, img
+
+
+def tile(encoder, img, size, top=0):
+    """ Encode `img` rows from `top` in rectangles of `size` """
+    height, width = img.shape[:2]
+    rects = []
+    for y in range(top, height, size):
+        for x in range(0, width, size):
+            w = min(size, width - x)
+            h = min(size, height - y)
+            rects.append(encoder.rect(img, x, y, w, h))
+
+    return rects
+
+
+# decoding
+
+class NullTransport(object):
+    """ Transport discarding client messages """
+
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+def client():
+    factory = VNCFactory()
+    factory.startedConnecting(None)
+    proto = VNC()
+    proto.factory = factory
+    proto.transport = NullTransport()
+    return proto
+
+
+def feed(proto, data, chunk):
+    for pos in range(0, len(data), chunk):
+        proto.dataReceived(data[pos:pos + chunk])
+
+
+def run(encoding, width, height, chunk, frames=3, seed=0):
+    """
+    Decode synthetic stream, returns dict of results
+    """
+
+    prelude, body, rects, img = stream(encoding, width, height,
+                                       frames, seed)
+    proto = client()
+    feed(proto, prelude, chunk)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    feed(proto, body, chunk)
+    elapsed = max(time.time() - start, 1e-9)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if encoding == 'tight-jpeg':
+        # lossy, compare loosely
+        diff = np.abs(proto.screen.astype(int) - img[:, :, :3]).mean()
+        ok = bool(diff < 8)
+    else:
+        ok = bool((proto.screen == img[:, :, :3]).all())
+
+    return {
+        'encoding': encoding,
+        'width': width,
+        'height': height,
+        'chunk': chunk,
+        'frames': frames,
+        'bytes': len(body),
+        'rects': rects,
+        'seconds': elapsed,
+        'mb_per_s': len(body) / elapsed / 1e6,
+        'rects_per_s': rects / elapsed,
+        'mpixels_per_s': frames * width * height / elapsed / 1e6,
+        'peak_rss_kb': peak,
+        'decode_rss_kb': peak - rss,
+        'ok': ok,
+    }
@@ -0,0 +1,77 @@
+def intersects(a, b, margin=0):
+    """
+    Return True if (x, y, w, h) rectangles `a` and `b` overlap
+    or are closer than `margin` pixels
+    """
+
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return (ax < bx + bw + margin and bx < ax + aw + margin and
+            ay < by + bh + margin and by < ay + ah + margin)
+
+
+def union(a, b):
+    """
+    Return bounding (x, y, w, h) rectangle of `a` and `b`
+    """
+
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    x = min(ax, bx)
+    y = min(ay, by)
+    return (x, y, max(ax + aw, bx + bw) - x, max(ay + ah, by + bh) - y)
+
+
+class DamageRegion(object):
+    """
+    Set of damaged (x, y, w, h) rectangles.
+
+    Overlapping or touching rectangles are coalesced as they are added,
+    once there are more than `max_rects` of them the region collapses
+    to their bounding box.
+    """
+
+    def __init__(self, max_rects=32):
+        self.max_rects = max_rects
+        self.rects = []
+
+    def add(self, rect):
+        x, y, w, h = rect
+        if w <= 0 or h <= 0:
+            return
+
+        merged = True
+        while merged:
+            merged = False
+            for other in self.rects:
+                if intersects(rect, other, margin=1):
+                    self.rects.remove(other)
+                    rect = union(rect, other)
+                    merged = True
+                    break
+
+        self.rects.append(rect)
+
+        if len(self.rects) > self.max_rects:
+            self.rects = [reduce(union, self.rects)]
+
+    def extend(self, rects):
+        for rect in rects:
+            self.add(rect)
+
+    def take(self):
+        """
+        Return damaged rectangles and clear the region
+        """
+
+        rects, self.rects = self.rects, []
+        return rects
+
+    def area(self):
+        return sum(w * h for (x, y, w, h) in self.rects)
+
+    def __iter__(self):
+        return iter(self.rects)
+
+    def __len__(self):
+        return len(self.rects)
@@ -0,0 +1,64 @@
+import damage
+
+
+def test_intersects():
+    assert damage.intersects((0, 0, 10, 10), (5, 5, 10, 10))
+    assert not damage.intersects((0, 0, 10, 10), (10, 0, 10, 10))
+    assert damage.intersects((0, 0, 10, 10), (10, 0, 10, 10), margin=1)
+
+
+def test_disjoint_kept_apart():
+    region = damage.DamageRegion()
+    region.extend([(0, 0, 10, 10), (50, 50, 10, 10)])
+    assert sorted(region) == [(0, 0, 10, 10), (50, 50, 10, 10)]
+    assert region.area() == 200
+
+
+def test_overlapping_and_touching_coalesce():
+    region = damage.DamageRegion()
+    region.add((0, 0, 10, 10))
+    region.add((5, 5, 10, 10))
+    assert list(region) == [(0, 0, 15, 15)]
+
+    # touching edge
+    region.add((15, 0, 5, 5))
+    assert list(region) == [(0, 0, 20, 15)]
+
+
+def test_bridging_rect_merges_chain():
+    region = damage.DamageRegion()
+    region.extend([(0, 0, 10, 10), (30, 0, 10, 10)])
+    assert len(region) == 2
+
+    region.add((8, 0, 24, 5))
+    assert list(region) == [(0, 0, 40, 10)]
+
+
+def test_empty_ignored():
+    region = damage.DamageRegion()
+    region.extend([(0, 0, 0, 10), (0, 0, 10, 0)])
+    assert len(region) == 0
+
+
+def test_collapse_over_max_rects():
+    region = damage.DamageRegion(max_rects=4)
+    for i in range(4):
+        region.add((i * 20, 0, 5, 5))
+    assert len(region) == 4
+
+    region.add((100, 100, 5, 5))
+    assert list(region) == [(0, 0, 105, 105)]
+
+
+def test_take_clears():
+    region = damage.DamageRegion()
+    region.add((0, 0, 10, 10))
+    assert region.take() == [(0, 0, 10, 10)]
+    assert len(region) == 0
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{0} ok'.format(name))
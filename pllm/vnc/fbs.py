@@ -0,0 +1,66 @@
+"""
+FBS (framebuffer stream) session recordings.
+
+File starts with "FBS 001.000\\n" followed by blocks of server to client
+data, each block is U32 length, data padded to 4 bytes and U32
+timestamp in milliseconds since the start of the recording.
+
+Format is compatible with rfbproxy and other FBS players.
+"""
+
+import time
+from struct import pack, unpack
+
+MAGIC = b'FBS 001.000\n'
+
+
+class FBSWriter(object):
+    """
+    Record data received by RFBClient to file `f`,
+    assign to RFBClient.recorder to use
+    """
+
+    def __init__(self, f, clock=time.time):
+        self.f = f
+        self.clock = clock
+        self.start = None
+        self.f.write(MAGIC)
+
+    def write(self, data):
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+
+        timestamp = int((now - self.start) * 1000)
+        padding = -len(data) % 4
+        self.f.write(pack("!I", len(data)))
+        self.f.write(data)
+        self.f.write(b'\0' * padding + pack("!I", timestamp))
+
+    def close(self):
+        self.f.close()
+
+
+def read(f):
+    """
+    Yield (timestamp, data) blocks of FBS file `f`,
+    timestamp is in seconds
+    """
+
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a FBS 001.000 file")
+
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+
+        (length,) = unpack("!I", header)
+        data = f.read(length)
+        trailer = f.read(-length % 4 + 4)
+        if len(trailer) < 4:
+            # recording was cut short
+            return
+
+        (timestamp,) = unpack("!I", trailer[-4:])
+        yield timestamp / 1000.0, data
@@ -0,0 +1,130 @@
+"""
+Bounded history of captured screens.
+
+Frames are stored in a preallocated ring of buffers. A buffer being
+reused already holds an older frame, so only tiles changed since then
+are copied into it.
+"""
+
+import time
+
+import numpy as np
+
+TILE_SIZE = 64
+
+
+class Frame(object):
+    """
+    Captured screen `image` with its `id`, capture `time` and
+    (x, y, w, h) `damage` rectangles changed against the previous frame.
+
+    `image` is a ring buffer, it is overwritten once the frame drops
+    out of the history, use FrameRing.get to check it is still there.
+    """
+
+    def __init__(self, id, time, damage, image):
+        self.id = id
+        self.time = time
+        self.damage = damage
+        self.image = image
+
+    def __repr__(self):
+        return '<Frame {0} damage={1}>'.format(self.id, len(self.damage))
+
+
+class FrameRing(object):
+    """
+    Last `size` frames, buffers are allocated on the first snapshot
+    and whenever the screen size changes.
+    """
+
+    def __init__(self, size=8, tile=TILE_SIZE):
+        self.size = size
+        self.tile = tile
+        self.next_id = 0
+        self.frames = [None] * size
+        self.buffers = None
+        # tiles changed by the frame stored in each slot
+        self.dirty = None
+        self.copied = 0
+
+    def reset(self, shape):
+        self.buffers = np.zeros((self.size,) + shape, dtype=np.uint8)
+        rows = (shape[0] + self.tile - 1) // self.tile
+        cols = (shape[1] + self.tile - 1) // self.tile
+        # empty buffers have to be copied whole
+        self.dirty = np.ones((self.size, rows, cols), dtype=np.bool_)
+        self.frames = [None] * self.size
+
+    def snapshot(self, image, damage=None):
+        """
+        Store copy of `image` changed only in (x, y, w, h) `damage`
+        rectangles since the last snapshot, everything is considered
+        changed without `damage`. Returns the new Frame.
+        """
+
+        if self.buffers is None or self.buffers.shape[1:] != image.shape:
+            self.reset(image.shape)
+
+        slot = self.next_id % self.size
+        self.dirty[slot] = self._tiles(damage)
+
+        # buffer holds frame `size` snapshots old, bring it up to date
+        # with changes of all newer frames
+        buf = self.buffers[slot]
+        stale = self.dirty.any(axis=0)
+        for row, start, end in self._runs(stale):
+            ys = slice(row * self.tile, (row + 1) * self.tile)
+            xs = slice(start * self.tile, end * self.tile)
+            buf[ys, xs] = image[ys, xs]
+            self.copied += end - start
+
+        frame = Frame(self.next_id, time.time(), list(damage or []), buf)
+        self.frames[slot] = frame
+        self.next_id += 1
+        return frame
+
+    def get(self, id):
+        """
+        Return Frame `id` or None if it is no longer stored
+        """
+
+        frame = self.frames[id % self.size]
+        if frame is not None and frame.id == id:
+            return frame
+
+    def latest(self):
+        if self.next_id == 0:
+            return None
+
+        return self.get(self.next_id - 1)
+
+    def __iter__(self):
+        """
+        Iterate stored frames from the oldest one
+        """
+
+        for id in range(max(0, self.next_id - self.size), self.next_id):
+            yield self.frames[id % self.size]
+
+    def _tiles(self, damage):
+        """ Bitmap of tiles touched by `damage` rectangles """
+        tiles = np.zeros(self.dirty.shape[1:], dtype=np.bool_)
+        if damage is None:
+            tiles[...] = True
+            return tiles
+
+        t = self.tile
+        for (x, y, w, h) in damage:
+            tiles[y // t:(y + h + t - 1) // t, x // t:(x + w + t - 1) // t] = 1
+
+        return tiles
+
+    def _runs(self, tiles):
+        """ Yield (row, start, end) runs of set tiles """
+        for row, cols in enumerate(tiles):
+            edges = np.diff(np.concatenate(([0], cols.view(np.int8), [0])))
+            starts = np.flatnonzero(edges == 1)
+            ends = np.flatnonzero(edges == -1)
+            for start, end in zip(starts, ends):
+                yield row, start, end
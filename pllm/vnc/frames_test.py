@@ -0,0 +1,78 @@
+import numpy as np
+
+import frames
+
+
+def screen(value, shape=(128, 192, 4)):
+    return np.full(shape, value, dtype=np.uint8)
+
+
+def test_first_snapshot_copies_everything():
+    ring = frames.FrameRing(size=2, tile=64)
+    frame = ring.snapshot(screen(1))
+    assert (frame.image == 1).all()
+    # 2 rows of 3 tiles
+    assert ring.copied == 6
+
+
+def test_wrapped_slot_copies_changed_tiles_only():
+    ring = frames.FrameRing(size=2, tile=64)
+    img = screen(0)
+    ring.snapshot(img)
+    ring.snapshot(img, [])
+    copied = ring.copied
+
+    # third snapshot reuses buffer of the first one, only the tile
+    # changed since then is copied
+    img[0:10, 70:80] = 5
+    frame = ring.snapshot(img, [(70, 0, 10, 10)])
+    assert ring.copied - copied == 1
+    assert (frame.image == img).all()
+
+
+def test_wrapped_slot_catches_up_with_newer_frames():
+    ring = frames.FrameRing(size=3, tile=64)
+    img = screen(0)
+    ring.snapshot(img)
+    ring.snapshot(img, [])
+    ring.snapshot(img, [])
+
+    # change seen by slot 0 only, slot 1 holds the old content
+    img[70:80, 0:10] = 7
+    ring.snapshot(img, [(0, 70, 10, 10)])
+    copied = ring.copied
+
+    # slot 1 must pick up the change of the previous frame too
+    img[0:10, 130:140] = 9
+    frame = ring.snapshot(img, [(130, 0, 10, 10)])
+    assert ring.copied - copied == 2
+    assert (frame.image == img).all()
+
+
+def test_history():
+    ring = frames.FrameRing(size=2, tile=64)
+    img = screen(0)
+    first = ring.snapshot(img)
+    second = ring.snapshot(img, [])
+    third = ring.snapshot(img, [(0, 0, 1, 1)])
+
+    assert ring.get(first.id) is None
+    assert ring.get(second.id) is second
+    assert ring.latest() is third
+    assert [f.id for f in ring] == [second.id, third.id]
+    assert third.damage == [(0, 0, 1, 1)]
+
+
+def test_resize_resets():
+    ring = frames.FrameRing(size=2, tile=64)
+    ring.snapshot(screen(1))
+    frame = ring.snapshot(screen(2, (64, 64, 4)), [])
+    assert frame.image.shape == (64, 64, 4)
+    assert (frame.image == 2).all()
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{0} ok'.format(name))
@@ -0,0 +1,121 @@
+"""
+Hub of VNC connections sharing one reactor.
+
+Every connection gets a decode budget, queued server data is decoded
+round robin one budget at a time so a busy guest can't starve the
+others. Framebuffers come from a pool shared by all connections.
+"""
+
+import collections
+
+import numpy as np
+
+from twisted.python import log
+from twisted.application import service
+from twisted.application.internet import TCPClient
+from twisted.internet import reactor
+
+from vnc import VNCFactory
+
+
+class FramebufferPool(object):
+    """
+    Free framebuffers by shape, guests usually share a few resolutions
+    so buffers released on resize or disconnect are reused by others
+    """
+
+    def __init__(self, max_free=4):
+        self.max_free = max_free
+        self.free = collections.defaultdict(list)
+        self.allocated = 0
+
+    def get(self, shape):
+        """ Return zeroed uint8 array of `shape` """
+        free = self.free[shape]
+        if free:
+            buf = free.pop()
+            buf.fill(0)
+            return buf
+
+        self.allocated += 1
+        return np.zeros(shape, dtype=np.uint8)
+
+    def put(self, buf):
+        free = self.free[buf.shape]
+        if len(free) < self.max_free:
+            free.append(buf)
+
+
+class VNCHub(service.MultiService):
+    """
+    Service managing named VNC connections, one per domain
+    """
+
+    # bytes of server data decoded per connection in one round
+    decode_budget = 256 * 1024
+
+    def __init__(self, pool=None):
+        service.MultiService.__init__(self)
+        self.pool = pool or FramebufferPool()
+        self.factories = {}
+        # connections with queued data
+        self.ready = collections.deque()
+        self.call = None
+
+    def add(self, name, host, port, decode_budget=None):
+        """ Connect to VNC server at `host`:`port`, returns VNCFactory """
+        log.msg('Adding VNC connection {0} to {1}:{2}'
+                .format(name, host, port))
+
+        factory = VNCFactory()
+        factory.hub = self
+        factory.pool = self.pool
+        factory.decode_budget = decode_budget or self.decode_budget
+        self.factories[name] = factory
+
+        client = TCPClient(host, port, factory)
+        client.setName(name)
+        client.setServiceParent(self)
+        return factory
+
+    def remove(self, name):
+        factory = self.factories.pop(name)
+        factory.stopTrying()
+        if factory.proto and factory.proto.transport:
+            factory.proto.transport.loseConnection()
+
+        return self.removeService(self.getServiceNamed(name))
+
+    def __getitem__(self, name):
+        """ Current connection of `name` or None """
+        return self.factories[name].proto
+
+    def schedule(self, proto):
+        """ `proto` has data queued for decoding """
+        if proto not in self.ready:
+            self.ready.append(proto)
+
+        if not self.call:
+            self.call = reactor.callLater(0, self.decode)
+
+    def decode(self):
+        """ Decode one budget of each ready connection, connections
+            with data left wait for the next round so network
+            reads and other connections get their turn """
+        self.call = None
+
+        for _ in range(len(self.ready)):
+            proto = self.ready.popleft()
+            try:
+                more = proto.decode(proto.factory.decode_budget)
+            except Exception:
+                # a broken stream must not stall the other connections
+                log.err(None, 'Decoding VNC data failed, disconnecting')
+                proto.transport.loseConnection()
+                continue
+
+            if more:
+                self.ready.append(proto)
+
+        if self.ready:
+            self.call = reactor.callLater(0, self.decode)
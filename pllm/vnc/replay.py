@@ -0,0 +1,93 @@
+"""
+Stand-in VNC server replaying FBS recordings.
+
+Recorded server data is sent as is and client messages are ignored,
+so the connecting client has to negotiate the same way as the one
+which made the recording (VNC always does).
+"""
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, Factory
+
+import fbs
+
+
+class ReplayProtocol(Protocol):
+    """
+    Send blocks of the recording, paced by their timestamps
+    unless replaying at max speed
+    """
+
+    def connectionMade(self):
+        log.msg('Replaying {0}'.format(self.factory.path))
+        self.file = open(self.factory.path, 'rb')
+        self.blocks = fbs.read(self.file)
+        self.started = reactor.seconds()
+        self.sent = 0
+        self.call = None
+        self.transport.registerProducer(self, False)
+
+    def dataReceived(self, data):
+        pass
+
+    def resumeProducing(self):
+        try:
+            timestamp, data = next(self.blocks)
+        except StopIteration:
+            self.finished()
+            return
+
+        self.sent += len(data)
+
+        delay = 0
+        if self.factory.speed:
+            delay = (self.started + timestamp / self.factory.speed -
+                     reactor.seconds())
+
+        if delay > 0:
+            self.call = reactor.callLater(delay, self.transport.write, data)
+        else:
+            self.transport.write(data)
+
+    def stopProducing(self):
+        if self.call and self.call.active():
+            self.call.cancel()
+
+    def finished(self):
+        elapsed = reactor.seconds() - self.started
+        log.msg('Replay finished, {0} bytes in {1:.3f}s'
+                .format(self.sent, elapsed))
+
+        self.transport.unregisterProducer()
+        self.file.close()
+        self.factory.replayFinished(self, elapsed)
+
+        # client gets no more updates, keep the connection open
+        # so it can finish processing
+        if self.factory.close:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.stopProducing()
+        self.file.close()
+
+
+class ReplayFactory(Factory):
+    """
+    Replay FBS recording at `path` to every client connecting,
+    `speed` multiplies the recorded pace, 0 sends the data as fast
+    as the client reads it
+    """
+
+    protocol = ReplayProtocol
+
+    def __init__(self, path, speed=1.0, close=False):
+        self.path = path
+        self.speed = speed
+        self.close = close
+        self.finished_callback = None
+
+    def replayFinished(self, protocol, elapsed):
+        if self.finished_callback:
+            self.finished_callback(protocol, elapsed)
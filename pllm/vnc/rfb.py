@@ -17,10 +17,15 @@ MIT License
 """
 
 import math
+import zlib
 from struct import pack, unpack
+import numpy as np
 from twisted.python import log
 from twisted.internet.protocol import ClientFactory, Protocol
 
+import tight
+import zrle
+
 #encoding-type
 #for SetEncodings()
 RAW_ENCODING = 0
@@ -33,6 +38,8 @@ TIGHT_ENCODING = 7
 ZLIBHEX_ENCODING = 8
 ZRLE_ENCODING = 16
 #0xffffff00 to 0xffffffff tight options
+PSEUDOENC_COMPRESS_LEVEL_0 = -256
+PSEUDOENC_QUALITY_LEVEL_0 = -32
 PSEUDOENC_CURSOR = -239
 PSEUDOENC_XCURSOR = -240
 PSEUDOENC_DESKTOP_SIZE = -223
@@ -41,41 +48,50 @@ PSEUDOENC_DESKTOP_NAME = -307
 PSEUDOENC_FENCE = -312
 PSEUDOENC_CONTINUOUS_UPDATES = -313
 
+#fence flags
+FENCE_BLOCK_BEFORE = 1
+FENCE_BLOCK_AFTER = 2
+FENCE_SYNC_NEXT = 4
+FENCE_REQUEST = 1 << 31
+
 
 class RFBClient(Protocol):
+    # object with write(data) method receiving all server data,
+    # see fbs.FBSWriter
+    recorder = None
 
     def __init__(self):
         self.debug = False
-        self._packet = []
-        self._packet_len = 0
+        # receive buffer, data before _offset is already consumed
+        self._buffer = bytearray()
+        self._offset = 0
         self._handler = self._handleInitial
         self._already_expecting = 0
+        # zlib streams persist for the whole connection
+        self._zrle_stream = zlib.decompressobj()
+        self._tight_streams = [zlib.decompressobj() for _ in range(4)]
 
     #------------------------------------------------------
     # states used on connection startup
     #------------------------------------------------------
 
     def _handleInitial(self):
-        buffer = ''.join(self._packet)
-        if '\n' in buffer:
-            if buffer[:3] == 'RFB':
+        if b'\n' in self._buffer:
+            buffer = bytes(self._buffer[:12])
+            if buffer[:3] == b'RFB':
                 #~ print "rfb"
-                major, minor = [int(x) for x in buffer[3:-1].split('.')]
+                major, minor = [int(x) for x in buffer[3:-1].split(b'.')]
                 if (major, minor) not in [(3, 3), (3, 7),
                                           (3, 8), (3, 889), (4, 0)]:
 
                     log.msg("wrong protocol version, {0}.{1}\n"
                             .format(major, minor))
                     self.transport.loseConnection()
-            buffer = buffer[12:]
-            self.transport.write('RFB 003.003\n')
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
+            self._offset = 12
+            self._compact()
+            self.transport.write(b'RFB 003.003\n')
             self._handler = self._handleExpected
             self.expect(self._handleAuth, 4)
-        else:
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
 
     def _handleAuth(self, block):
         (auth,) = unpack("!I", block)
@@ -95,10 +111,10 @@ class RFBClient(Protocol):
         self.expect(self._handleConnMessage, waitfor)
 
     def _handleConnMessage(self, block):
-        log.msg("Connection refused: {0}".format(block))
+        log.msg("Connection refused: {0}".format(block.tobytes()))
 
     def _handleVNCAuth(self, block):
-        self._challenge = block
+        self._challenge = block.tobytes()
         self.vncRequestPassword()
         self.expect(self._handleVNCAuthResult, 4)
 
@@ -131,7 +147,7 @@ class RFBClient(Protocol):
         self.expect(self._handleServerName, namelen)
 
     def _handleServerName(self, block):
-        self.name = block
+        self.name = block.tobytes()
         #callback:
         self.vncConnectionMade()
         self.expect(self._handleConnection, 1)
@@ -148,6 +164,11 @@ class RFBClient(Protocol):
             self.expect(self._handleConnection, 1)
         elif msgid == 3:
             self.expect(self._handleServerCutText, 7)
+        elif msgid == 150:
+            self.endOfContinuousUpdates()
+            self.expect(self._handleConnection, 1)
+        elif msgid == 248:
+            self.expect(self._handleFence, 8)
         else:
             if self.debug:
                 log.msg("unknown message received (id {0})".format(msgid))
@@ -170,7 +191,8 @@ class RFBClient(Protocol):
         (x, y, width, height, encoding) = unpack("!HHHHi", block)
         if self.rectangles:
             self.rectangles -= 1
-            self.rectanglePos.append((x, y, width, height))
+            if encoding >= 0:   # pseudo encodings carry no pixels
+                self.rectanglePos.append((x, y, width, height))
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
             elif encoding == RAW_ENCODING:
@@ -185,16 +207,21 @@ class RFBClient(Protocol):
             elif encoding == RRE_ENCODING:
                 self.expect(self._handleDecodeRRE,
                             4 + self.bypp, x, y, width, height)
-            #~ elif encoding == ZRLE_ENCODING:
-                #~ self.expect(self._handleDecodeZRLE, )
+            elif encoding == ZRLE_ENCODING:
+                self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handleDecodeTight, 1, x, y, width, height)
             elif encoding == PSEUDOENC_CURSOR:
                 length = width * height * self.bypp
                 length += int(math.floor((width + 7.0) / 8)) * height
                 self.expect(self._handleDecodePsuedoCursor,
                             length, x, y, width, height)
+            elif encoding == PSEUDOENC_DESKTOP_SIZE:
+                self._doDesktopSize(width, height)
+            elif encoding == PSEUDOENC_EXTENDED_DESKTOP_SIZE:
+                self.expect(self._handleDecodeExtendedDesktopSize, 4,
+                            x, y, width, height)
             elif encoding in [
-                    PSEUDOENC_DESKTOP_SIZE,
-                    PSEUDOENC_EXTENDED_DESKTOP_SIZE,
                     PSEUDOENC_CONTINUOUS_UPDATES,
                     PSEUDOENC_FENCE,
                     PSEUDOENC_XCURSOR]:
@@ -208,6 +235,26 @@ class RFBClient(Protocol):
         else:
             self._doConnection()
 
+    # ---  DesktopSize and ExtendedDesktopSize pseudo encodings
+    def _doDesktopSize(self, width, height):
+        self.width, self.height = width, height
+        self.desktopResized(width, height)
+        self._doConnection()
+
+    def _handleDecodeExtendedDesktopSize(self, block, x, y, width, height):
+        (screens,) = unpack("!Bxxx", block)
+        self.expect(self._handleDecodeExtendedDesktopSizeScreens,
+                    screens * 16, x, y, width, height)
+
+    def _handleDecodeExtendedDesktopSizeScreens(self, block,
+                                                x, y, width, height):
+        # x is the reason and y the status of the change,
+        # non-zero status means our resize request failed
+        if y == 0 and (width, height) != (self.width, self.height):
+            self._doDesktopSize(width, height)
+        else:
+            self._doConnection()
+
     # ---  RAW Encoding
     def _handleDecodeRAW(self, block, x, y, width, height):
         #TODO convert pixel format?
@@ -223,46 +270,40 @@ class RFBClient(Protocol):
     # ---  RRE Encoding
     def _handleDecodeRRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
+        color = block[4:].tobytes()
         self.fillRectangle(x, y, width, height, color)
         if subrects:
             self.expect(self._handleRRESubRectangles,
-                        (8 + self.bypp) * subrects, x, y)
+                        (8 + self.bypp) * subrects, x, y, width, height)
         else:
             self._doConnection()
 
-    def _handleRRESubRectangles(self, block, topx, topy):
+    def _handleRRESubRectangles(self, block, x, y, width, height):
         #~ print "_handleRRESubRectangle"
-        pos = 0
-        end = len(block)
-        sz = self.bypp + 8
-        format = "!{0}sHHHH".format(self.bypp)
-        while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos:pos + sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        subrects = np.asarray(block).reshape((-1, self.bypp + 8))
+        coords = np.ascontiguousarray(subrects[:, self.bypp:])
+        rects = coords.view('>u2').astype(np.intp) + (x, y, 0, 0)
+        self.fillRectangles(x, y, width, height,
+                            subrects[:, :self.bypp], rects)
         self._doConnection()
 
     # ---  CoRRE Encoding
     def _handleDecodeCORRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
+        color = block[4:].tobytes()
         self.fillRectangle(x, y, width, height, color)
         if subrects:
             self.expect(self._handleDecodeCORRERectangles,
-                        (4 + self.bypp) * subrects, x, y)
+                        (4 + self.bypp) * subrects, x, y, width, height)
         else:
             self._doConnection()
 
-    def _handleDecodeCORRERectangles(self, block, topx, topy):
+    def _handleDecodeCORRERectangles(self, block, x, y, width, height):
         #~ print "_handleDecodeCORRERectangle"
-        pos = 0
-        sz = self.bypp + 4
-        format = "!{0}sBBBB".format(self.bypp)
-        while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos:pos + sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        subrects = np.asarray(block).reshape((-1, self.bypp + 4))
+        rects = subrects[:, self.bypp:].astype(np.intp) + (x, y, 0, 0)
+        self.fillRectangles(x, y, width, height,
+                            subrects[:, :self.bypp], rects)
         self._doConnection()
 
     # ---  Hexile Encoding
@@ -327,15 +368,14 @@ class RFBClient(Protocol):
         subrects = 0
         pos = 0
         if subencoding & 2:     # BackgroundSpecified
-            bg = block[:self.bypp]
+            bg = block[:self.bypp].tobytes()
             pos += self.bypp
         self.fillRectangle(tx, ty, tw, th, bg)
         if subencoding & 4:     # ForegroundSpecified
-            color = block[pos:pos + self.bypp]
+            color = block[pos:pos + self.bypp].tobytes()
             pos += self.bypp
         if subencoding & 8:     # AnySubrects
-            #~ (subrects, ) = unpack("!B", block)
-            subrects = ord(block[pos])
+            (subrects, ) = unpack("!B", block[pos:pos + 1])
         #~ print subrects
         if subrects:
             if subencoding & 16:  # SubrectsColoured
@@ -361,20 +401,12 @@ class RFBClient(Protocol):
                                              tx, ty, tw, th):
         """ Decode subrects with their own color """
 
-        sz = self.bypp + 2
-        pos = 0
-        end = len(block)
-        while pos < end:
-            pos2 = pos + self.bypp
-            color = block[pos:pos2]
-            xy = ord(block[pos2])
-            wh = ord(block[pos2 + 1])
-            sx = xy >> 4
-            sy = xy & 0xf
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += sz
+        subrects = np.asarray(block).reshape((-1, self.bypp + 2))
+        colors = subrects[:, :self.bypp]
+        rects = self._hextileRects(subrects[:, self.bypp:], tx, ty)
+        self.fillRectangles(tx, ty, tw, th, colors, rects)
+        # last subrect color becomes foreground of following tiles
+        color = colors[-1].tobytes()
         self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
     def _handleDecodeHextileSubrectsFG(self, block, bg, color,
@@ -382,22 +414,181 @@ class RFBClient(Protocol):
                                        tx, ty, tw, th):
         """ all subrect with same color """
 
-        pos = 0
-        end = len(block)
-        while pos < end:
-            xy = ord(block[pos])
-            wh = ord(block[pos + 1])
-            sx = xy >> 4
-            sy = xy & 0xf
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += 2
+        rects = self._hextileRects(np.asarray(block).reshape((-1, 2)),
+                                   tx, ty)
+        colors = np.frombuffer(color, dtype=np.uint8)
+        colors = np.repeat(colors[None], len(rects), axis=0)
+        self.fillRectangles(tx, ty, tw, th, colors, rects)
         self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
+    def _hextileRects(self, packed, tx, ty):
+        """ Unpack (n, 2) array of x-y and width-height nibbles
+            to (n, 4) array of absolute (x, y, width, height) """
+        packed = packed.astype(np.intp)
+        rects = np.empty((len(packed), 4), dtype=np.intp)
+        rects[:, 0] = tx + (packed[:, 0] >> 4)
+        rects[:, 1] = ty + (packed[:, 0] & 0xf)
+        rects[:, 2] = (packed[:, 1] >> 4) + 1
+        rects[:, 3] = (packed[:, 1] & 0xf) + 1
+        return rects
+
     # ---  ZRLE Encoding
-    def _handleDecodeZRLE(self, block):
-        raise NotImplementedError
+    def _handleDecodeZRLE(self, block, x, y, width, height):
+        (length,) = unpack("!I", block)
+        self.expect(self._handleDecodeZRLEData,
+                    length, x, y, width, height)
+
+    def _handleDecodeZRLEData(self, block, x, y, width, height):
+        data = self._zrle_stream.decompress(block.tobytes())
+        cbypp, offset = self._cpixelFormat()
+        pixels = zrle.decode(data, width, height, self.bypp, cbypp, offset)
+        self.updateRectangle(x, y, width, height, memoryview(pixels))
+        self._doConnection()
+
+    def _cpixelFormat(self):
+        """ Size and byte offset of compressed ZRLE pixel (CPIXEL)
+
+            Only 3 bytes are sent for 32bpp true color pixel formats
+            which fit into either least or most significant 3 bytes.
+        """
+        if self.truecolor and self.bpp == 32 and self.depth <= 24:
+            colors = [(self.redmax, self.redshift),
+                      (self.greenmax, self.greenshift),
+                      (self.bluemax, self.blueshift)]
+
+            if all((cmax << shift) < (1 << 24) for cmax, shift in colors):
+                return 3, int(bool(self.bigendian))
+
+            if all(shift >= 8 for cmax, shift in colors):
+                return 3, int(not self.bigendian)
+
+        return self.bypp, 0
+
+    # ---  Tight Encoding
+    def _handleDecodeTight(self, block, x, y, width, height):
+        (ctl,) = unpack("!B", block)
+        for stream in range(4):
+            if ctl & (1 << stream):
+                self._tight_streams[stream] = zlib.decompressobj()
+
+        ctl >>= 4
+        tbypp, shifts = self._tpixelFormat()
+        if ctl == 8:      # FillCompression
+            self.expect(self._handleDecodeTightFill,
+                        tbypp, x, y, width, height)
+        elif ctl == 9:    # JpegCompression
+            self._expectCompactLength(self._handleDecodeTightJPEG,
+                                      x, y, width, height)
+        elif ctl < 8:     # BasicCompression
+            stream = ctl & 3
+            if ctl & 4:   # explicit filter
+                self.expect(self._handleDecodeTightFilter,
+                            1, stream, x, y, width, height)
+            else:
+                self._doTightData(tight.FILTER_COPY, None, stream,
+                                  x, y, width, height)
+        else:
+            log.msg("unknown tight compression ({0})".format(ctl))
+            self.transport.loseConnection()
+
+    def _handleDecodeTightFill(self, block, x, y, width, height):
+        color = self._tpixels(block.tobytes(), (1,))[0]
+        self.fillRectangle(x, y, width, height, color.tobytes())
+        self._doConnection()
+
+    def _handleDecodeTightJPEG(self, block, x, y, width, height):
+        self.jpegRectangle(x, y, width, height, block)
+        self._doConnection()
+
+    def _handleDecodeTightFilter(self, block, stream, x, y, width, height):
+        (filterid,) = unpack("!B", block)
+        if filterid == tight.FILTER_PALETTE:
+            self.expect(self._handleDecodeTightPaletteSize,
+                        1, stream, x, y, width, height)
+        else:
+            self._doTightData(filterid, None, stream, x, y, width, height)
+
+    def _handleDecodeTightPaletteSize(self, block, stream,
+                                      x, y, width, height):
+        (colors,) = unpack("!B", block)
+        tbypp, shifts = self._tpixelFormat()
+        self.expect(self._handleDecodeTightPalette, (colors + 1) * tbypp,
+                    stream, x, y, width, height)
+
+    def _handleDecodeTightPalette(self, block, stream, x, y, width, height):
+        tbypp, shifts = self._tpixelFormat()
+        colors = len(block) // tbypp
+        palette = self._tpixels(block.tobytes(), (colors,))
+        self._doTightData(tight.FILTER_PALETTE, palette, stream,
+                          x, y, width, height)
+
+    def _doTightData(self, filterid, palette, stream, x, y, width, height):
+        tbypp, shifts = self._tpixelFormat()
+        colors = len(palette) if palette is not None else 0
+        size = tight.data_size(filterid, colors, width, height, tbypp)
+        if size < tight.MIN_TO_COMPRESS:
+            self.expect(self._handleDecodeTightData, size,
+                        filterid, palette, None, x, y, width, height)
+        else:
+            self._expectCompactLength(self._handleDecodeTightData,
+                                      filterid, palette, stream,
+                                      x, y, width, height)
+
+    def _handleDecodeTightData(self, block, filterid, palette, stream,
+                               x, y, width, height):
+        data = block.tobytes()
+        if stream is not None:
+            data = self._tight_streams[stream].decompress(data)
+
+        if filterid == tight.FILTER_PALETTE:
+            indices = tight.palette_indices(data, width, height, len(palette))
+            pixels = palette[indices]
+        elif filterid == tight.FILTER_GRADIENT:
+            tbypp, shifts = self._tpixelFormat()
+            if shifts is None:
+                raise ValueError("tight gradient filter needs 24bit pixels")
+            pixels = tight.rgb_pixels(tight.gradient(data, width, height),
+                                      self.bypp, shifts, self.bigendian)
+        else:
+            pixels = self._tpixels(data, (height, width))
+
+        self.updateRectangle(x, y, width, height, memoryview(pixels))
+        self._doConnection()
+
+    def _tpixelFormat(self):
+        """ Size of Tight pixel (TPIXEL) and color shifts if it is
+            sent as 3 bytes in R, G, B order, which is the case for
+            32bpp 24 depth true color formats.
+        """
+        if (self.truecolor and self.bpp == 32 and self.depth == 24 and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            return 3, (self.redshift, self.greenshift, self.blueshift)
+
+        return self.bypp, None
+
+    def _tpixels(self, data, shape):
+        tbypp, shifts = self._tpixelFormat()
+        return tight.tpixels(data, shape, self.bypp, shifts, self.bigendian)
+
+    def _expectCompactLength(self, handler, *args):
+        """ Read compact length (1-3 bytes, 7 bits each with
+            continuation bit) and expect block of that size """
+        self.expect(self._handleCompactLength, 1, 0, 0, handler, args)
+
+    def _handleCompactLength(self, block, length, shift, handler, args):
+        (value,) = unpack("!B", block)
+        if shift < 14:
+            length |= (value & 0x7f) << shift
+            more = value & 0x80
+        else:
+            length |= value << shift
+            more = 0
+
+        if more:
+            self.expect(self._handleCompactLength, 1,
+                        length, shift + 7, handler, args)
+        else:
+            self.expect(handler, length, *args)
 
     # --- Pseudo Cursor Encoding
     def _handleDecodePsuedoCursor(self, block, x, y, width, height):
@@ -414,7 +605,21 @@ class RFBClient(Protocol):
         self.expect(self._handleServerCutTextValue, length)
 
     def _handleServerCutTextValue(self, block):
-        self.copy_text(block)
+        self.copy_text(block.tobytes())
+        self.expect(self._handleConnection, 1)
+
+    def _handleFence(self, block):
+        (flags, length) = unpack("!xxxIB", block)
+        self.expect(self._handleFencePayload, length, flags)
+
+    def _handleFencePayload(self, block, flags):
+        payload = block.tobytes()
+        if flags & FENCE_REQUEST:
+            # messages are processed in order so blocking is implicit,
+            # SyncNext is not supported and has to be cleared
+            self.fence(flags & (FENCE_BLOCK_BEFORE | FENCE_BLOCK_AFTER),
+                       payload)
+        self.fenceReceived(flags, payload)
         self.expect(self._handleConnection, 1)
 
     #------------------------------------------------------
@@ -422,24 +627,46 @@ class RFBClient(Protocol):
     #------------------------------------------------------
     def dataReceived(self, data):
         #~ sys.stdout.write(repr(data) + '\n')
-        #~ print len(data), ", ", len(self._packet)
-        self._packet.append(data)
-        self._packet_len += len(data)
+        #~ print len(data), ", ", len(self._buffer) - self._offset
+        if self.recorder:
+            self.recorder.write(data)
+        self._buffer.extend(data)
         self._handler()
 
     def _handleExpected(self):
-        if self._packet_len >= self._expected_len:
-            buffer = ''.join(self._packet)
-            while len(buffer) >= self._expected_len:
-                self._already_expecting = 1
-                block = buffer[:self._expected_len]
-                buffer = buffer[self._expected_len:]
-                self._expected_handler(block, *self._expected_args,
+        if len(self._buffer) - self._offset < self._expected_len:
+            return
+
+        # handlers get memoryview blocks of the receive buffer so large
+        # rectangles are never copied, blocks are only valid during the call
+        view = memoryview(self._buffer)
+        self._already_expecting = 1
+        try:
+            while len(self._buffer) - self._offset >= self._expected_len:
+                start = self._offset
+                self._offset += self._expected_len
+                self._expected_handler(view[start:self._offset],
+                                       *self._expected_args,
                                        **self._expected_kwargs)
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
+        finally:
+            del view
             self._already_expecting = 0
 
+        self._compact()
+
+    def _compact(self):
+        """ Drop consumed data from the receive buffer """
+
+        if not self._offset:
+            return
+
+        try:
+            del self._buffer[:self._offset]
+        except BufferError:
+            # some handler still holds a block, leave old buffer to it
+            self._buffer = self._buffer[self._offset:]
+        self._offset = 0
+
     def expect(self, handler, size, *args, **kwargs):
         self._expected_handler = handler
         self._expected_len = size
@@ -510,6 +737,26 @@ class RFBClient(Protocol):
         """
         self.transport.write(pack("!BxxxI", 6, len(message)) + message)
 
+    def enableContinuousUpdates(self, enable=1, x=0, y=0,
+                                width=None, height=None):
+        """Ask server to send updates of the area without waiting for
+           framebufferUpdateRequest(). Only valid once the server
+           announced support by sending EndOfContinuousUpdates.
+        """
+        if width is None:
+            width = self.width - x
+        if height is None:
+            height = self.height - y
+        self.transport.write(pack("!BBHHHH", 150, enable,
+                                  x, y, width, height))
+
+    def fence(self, flags, payload=b''):
+        """Send fence with up to 64 bytes of payload, server replies
+           with the same payload if FENCE_REQUEST is set in flags.
+        """
+        self.transport.write(pack("!BxxxIB", 248, flags, len(payload)) +
+                             payload)
+
     #------------------------------------------------------
     # callbacks
     # override these in your application
@@ -542,9 +789,18 @@ class RFBClient(Protocol):
            argument is a list of tuples (x,y,w,h) with the updated
            rectangles."""
 
+    def desktopResized(self, width, height):
+        """framebuffer size changed to width x height, the update
+           following the change repaints the whole framebuffer."""
+
     def updateRectangle(self, x, y, width, height, data):
-        """new bitmap data. data is a string in the pixel format set
-           up earlier."""
+        """new bitmap data. data is a buffer (string or memoryview)
+           in the pixel format set up earlier. memoryview data is only
+           valid during the call, copy it if you need to keep it."""
+
+    def jpegRectangle(self, x, y, width, height, data):
+        """new JPEG compressed bitmap data (tight encoding).
+           data is a memoryview valid only during the call"""
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
@@ -557,8 +813,19 @@ class RFBClient(Protocol):
         #override with specialized function for better performance
         self.updateRectangle(x, y, width, height, color * width * height)
 
+    def fillRectangles(self, x, y, width, height, colors, rects):
+        """fill subrectangles of area (x, y, width, height) in order,
+           used by RRE, CoRRE and Hextile encodings. colors is (n, bypp)
+           ndarray of pixels in the pixel format set up earlier, rects
+           is (n, 4) ndarray of absolute (x, y, width, height)"""
+        #fallback variant, use fill rectangle
+        #override with batched function for better performance
+        for color, (sx, sy, sw, sh) in zip(colors, rects):
+            self.fillRectangle(sx, sy, sw, sh, color.tobytes())
+
     def updateCursor(self, x, y, width, height, image, mask):
         """ New cursor, focuses at (x, y)
+            image and mask are memoryviews valid only during the call
         """
 
     def bell(self):
@@ -568,6 +835,14 @@ class RFBClient(Protocol):
         """The server has new ASCII text in its cut buffer.
            (aka clipboard)"""
 
+    def endOfContinuousUpdates(self):
+        """continuous updates are supported by the server (first
+           message) or were disabled on our request."""
+
+    def fenceReceived(self, flags, payload):
+        """fence received from the server, requests (FENCE_REQUEST
+           in flags) are already answered at this point."""
+
 
 class RFBFactory(ClientFactory):
     """A factory for remote frame buffer connections."""
@@ -0,0 +1,110 @@
+import collections
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+
+class SettleDetector(object):
+    """
+    Detect when the screen settles after a change.
+
+    Screen is considered settled when no update damaging at least
+    `min_area` pixels arrived for `window` seconds. Waiting is capped
+    to `max_wait` seconds since the first change.
+    """
+
+    def __init__(self, window=0.5, max_wait=4.0, min_area=64,
+                 clock=reactor):
+        self.window = window
+        self.max_wait = max_wait
+        self.min_area = min_area
+        self.clock = clock
+
+        self.deferred = None
+        self.call = None
+
+        # changes not yet reported by a settle
+        self.first_change = None
+        self.last_change = None
+        self.updates = 0
+        self.area = 0
+
+        self.last = None
+        self.history = collections.deque(maxlen=100)
+
+    def wait(self):
+        """
+        Return Deferred fired with settle time once the next change
+        settles. Changes which arrived since the last settle count
+        as well so they are not missed.
+        """
+
+        self.deferred = Deferred()
+        if self.first_change is not None:
+            self._schedule(self.clock.seconds())
+
+        return self.deferred
+
+    def update(self, rectangles):
+        """
+        Account update consisting of (x, y, w, h) `rectangles`
+        """
+
+        now = self.clock.seconds()
+        area = sum(w * h for (x, y, w, h) in rectangles)
+
+        self.updates += 1
+        self.area += area
+
+        if self.first_change is None:
+            self.first_change = now
+        elif area < self.min_area:
+            # cursor blinks and clocks should not postpone settling
+            return
+
+        self.last_change = now
+
+        if self.deferred:
+            self._schedule(now)
+
+    def _schedule(self, now):
+        deadline = min(self.last_change + self.window,
+                       self.first_change + self.max_wait)
+        delay = max(0, deadline - now)
+
+        if self.call and self.call.active():
+            self.call.reset(delay)
+        else:
+            self.call = self.clock.callLater(delay, self._settled)
+
+    def _settled(self):
+        now = self.clock.seconds()
+        self.last = {
+            'time': now - self.first_change,
+            'updates': self.updates,
+            'area': self.area,
+            'rate': self.updates / max(now - self.first_change, 1e-3),
+            'capped': now - self.first_change >= self.max_wait,
+        }
+        self.history.append(self.last['time'])
+
+        self.first_change = self.last_change = None
+        self.updates = self.area = 0
+
+        d, self.deferred = self.deferred, None
+        d.callback(self.last['time'])
+
+    def stats(self):
+        """
+        Return summary of observed settle times
+        """
+
+        if not self.history:
+            return {'count': 0}
+
+        return {
+            'count': len(self.history),
+            'mean': sum(self.history) / len(self.history),
+            'max': max(self.history),
+            'last': self.last,
+        }
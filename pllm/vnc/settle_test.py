@@ -0,0 +1,73 @@
+from twisted.internet.task import Clock
+
+import settle
+
+
+def detector():
+    clock = Clock()
+    return clock, settle.SettleDetector(window=0.5, max_wait=4.0,
+                                        min_area=64, clock=clock)
+
+
+def test_settles_after_window():
+    clock, s = detector()
+    res = []
+    s.wait().addCallback(res.append)
+
+    s.update([(0, 0, 100, 100)])
+    clock.advance(0.3)
+    s.update([(0, 0, 100, 100)])
+    clock.advance(0.3)
+    assert res == []
+
+    clock.advance(0.2)
+    assert res == [0.8]
+    assert s.last['updates'] == 2
+    assert not s.last['capped']
+
+
+def test_changes_before_wait_count():
+    clock, s = detector()
+    s.update([(0, 0, 100, 100)])
+    clock.advance(1)
+
+    res = []
+    s.wait().addCallback(res.append)
+    clock.advance(0)
+    assert res == [1]
+
+
+def test_max_wait_caps():
+    clock, s = detector()
+    res = []
+    s.wait().addCallback(res.append)
+
+    for i in range(20):
+        s.update([(0, 0, 100, 100)])
+        clock.advance(0.25)
+
+    assert res == [4.0]
+    assert s.last['capped']
+
+
+def test_small_updates_do_not_postpone():
+    clock, s = detector()
+    res = []
+    s.wait().addCallback(res.append)
+
+    s.update([(0, 0, 100, 100)])
+    for i in range(2):
+        clock.advance(0.2)
+        # blinking cursor
+        s.update([(10, 10, 2, 16)])
+
+    clock.advance(0.1)
+    assert res == [0.5]
+    assert s.last['updates'] == 3
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{0} ok'.format(name))
@@ -0,0 +1,104 @@
+"""
+Tight encoding pixel decoding helpers.
+
+Framing, zlib streams and JPEG hand-off are handled by RFBClient,
+this module converts already decompressed Tight data into pixels
+in the client pixel format.
+
+Reference:
+https://github.com/rfbproto/rfbproto/blob/master/rfbproto.rst
+"""
+
+import numpy as np
+
+FILTER_COPY = 0
+FILTER_PALETTE = 1
+FILTER_GRADIENT = 2
+
+# data shorter than this is sent without zlib compression
+MIN_TO_COMPRESS = 12
+
+
+def data_size(filterid, colors, width, height, tbypp):
+    """
+    Size of filtered rectangle data for `filterid`,
+    `colors` is the size of palette for FILTER_PALETTE
+    """
+
+    if filterid == FILTER_PALETTE:
+        if colors == 2:
+            return (width + 7) // 8 * height
+        return width * height
+
+    return width * height * tbypp
+
+
+def tpixels(data, shape, bypp, shifts=None, bigendian=0):
+    """
+    Convert TPIXEL `data` to ndarray of `shape` + (bypp,)
+    in the client pixel format.
+
+    `shifts` (red, green, blue) are given only when TPIXELs
+    are sent as 3 bytes in R, G, B order.
+    """
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if shifts is None:
+        return buf.reshape(shape + (bypp,))
+
+    return rgb_pixels(buf.reshape(shape + (3,)), bypp, shifts, bigendian)
+
+
+def rgb_pixels(rgb, bypp, shifts, bigendian=0):
+    """
+    Place R, G, B components of `rgb` ndarray to their
+    byte positions given by `shifts` of the client pixel format
+    """
+
+    out = np.zeros(rgb.shape[:-1] + (bypp,), dtype=np.uint8)
+    for channel, shift in enumerate(shifts):
+        index = shift // 8
+        if bigendian:
+            index = bypp - 1 - index
+        out[..., index] = rgb[..., channel]
+
+    return out
+
+
+def palette_indices(data, width, height, colors):
+    """
+    Palette indices of FILTER_PALETTE `data`, returns (height, width)
+    ndarray. Two color palettes use one bit per pixel, rows are padded
+    to byte boundary.
+    """
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if colors == 2:
+        packed = buf.reshape((height, (width + 7) // 8))
+        return np.unpackbits(packed, axis=1)[:, :width]
+
+    return buf.reshape((height, width))
+
+
+def gradient(data, width, height):
+    """
+    Reverse gradient filter of 3 byte RGB `data`,
+    returns (height, width, 3) ndarray.
+
+    Every pixel is predicted as left + up - upper left clamped to
+    the component range, so pixels on one anti-diagonal depend only
+    on the previous two and are reconstructed at once.
+    """
+
+    diff = np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3))
+    # zero border on top and left simplifies edge handling
+    out = np.zeros((height + 1, width + 1, 3), dtype=np.int16)
+
+    for k in range(width + height - 1):
+        ys = np.arange(max(0, k - width + 1), min(height, k + 1))
+        xs = k - ys
+        predicted = out[ys + 1, xs] + out[ys, xs + 1] - out[ys, xs]
+        np.clip(predicted, 0, 255, out=predicted)
+        out[ys + 1, xs + 1] = (predicted + diff[ys, xs]) & 255
+
+    return out[1:, 1:].astype(np.uint8)
@@ -1,3 +1,7 @@
+import threading
+import collections
+from struct import pack
+
 import cv2
 import numpy as np
 
@@ -6,9 +10,28 @@ from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import ReconnectingClientFactory
 
+from pllm import config
 
 import rfb
 import keys
+import damage
+import fbs
+import frames
+import settle
+
+
+def pixels(data, width, height):
+    """
+    Wrap pixel `data` (string or memoryview) as (height, width, bypp)
+    ndarray without copying
+    """
+
+    if isinstance(data, memoryview):
+        buf = np.asarray(data)
+    else:
+        buf = np.frombuffer(data, dtype=np.uint8)
+
+    return buf.reshape((height, width, -1))
 
 
 # key/mouse* methods from vncdotool.client (MIT License)
@@ -18,15 +41,214 @@ class VNC(rfb.RFBClient):
     x = 0
     y = 0
     buttons = 0
-    screen = None
-    deferred = None
+    # BGRX pixels as sent by the server, see screen for BGR view
+    framebuffer = None
+    # BGRA cursor image and its hotspot, the server leaves cursor
+    # out of the framebuffer as we draw it ourselves
+    cursor = None
+    cursor_hotspot = (0, 0)
+
+    # last text received from the server clipboard
+    cut_text = None
+
+    # server pushes updates on its own, no need to request them
+    continuous_updates = False
+    # server supports continuous updates and fences
+    continuous_updates_supported = False
+    fences_supported = False
+    # updates are not requested while consumers lag behind
+    updates_paused = False
+    # framebuffer was kept from the previous connection
+    resumed = False
+
+    # reading from the server stops while this many bytes
+    # wait for decoding by the hub
+    inbound_limit = 4 << 20
+
+    # tight JPEG quality and zlib compression level (0-9),
+    # JPEG is lossy so it is only requested when quality is set
+    quality_level = None
+    compress_level = None
+
+    # batched subrectangle fills are painted in one pass while
+    # the coverage mask (subrects x area) stays below this size
+    fill_mask_limit = 1 << 18
+
+    # pointer moves sent per second at most, moves queued in between
+    # are coalesced to the latest position, 0 disables the cap
+    pointer_rate = 60
+
+    def __init__(self):
+        rfb.RFBClient.__init__(self)
+        # (move, message) input events waiting for the next flush,
+        # filled from the interpreter thread as well
+        self._input = []
+        self._input_lock = threading.Lock()
+        self._input_call = None
+        self._input_scheduled = False
+        self._input_mask = 0
+        self._pointer_sent = 0
+        self.pointer_rate = config.get('pointer_rate', self.pointer_rate)
+        self._fence_id = 0
+        self._fences = {}
+        self._sync_waiters = []
+        self._cut_text_waiters = []
+        self._synced = False
+        self.bytes_received = 0
+        # server data queued for decoding by the hub
+        self._inbound = collections.deque()
+        self._inbound_size = 0
+        self._reading_paused = False
+        # areas changed since the last capture
+        self.damage = damage.DamageRegion()
+        # captured screens
+        self.frames = frames.FrameRing(size=config.get('frame_history', 8))
+        self.settle = settle.SettleDetector(
+            window=config.get('settle_window', 0.5),
+            max_wait=config.get('settle_max_wait', 4.0),
+            min_area=config.get('settle_min_area', 64))
+
+    def resume(self, previous):
+        """ Take over screen state of `previous` connection """
+        self.framebuffer = previous.framebuffer
+        self.frames = previous.frames
+        self.damage = previous.damage
+        self.settle = previous.settle
+        self.cursor = previous.cursor
+        self.cursor_hotspot = previous.cursor_hotspot
+        self.cut_text = previous.cut_text
+        self.x, self.y = previous.x, previous.y
+
+    def dataReceived(self, data):
+        self.bytes_received += len(data)
+        if not self.factory.hub:
+            rfb.RFBClient.dataReceived(self, data)
+            return
+
+        self._inbound.append(data)
+        self._inbound_size += len(data)
+        if self._inbound_size > self.inbound_limit and \
+                not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pauseProducing()
+
+        self.factory.hub.schedule(self)
+
+    def decode(self, budget):
+        """ Decode up to `budget` bytes of queued server data,
+            return True if more data is queued """
+        while self._inbound and budget > 0:
+            data = self._inbound.popleft()
+            if len(data) > budget:
+                self._inbound.appendleft(data[budget:])
+                data = data[:budget]
+
+            budget -= len(data)
+            self._inbound_size -= len(data)
+            rfb.RFBClient.dataReceived(self, data)
+
+        if self._reading_paused and \
+                self._inbound_size < self.inbound_limit // 2:
+            self._reading_paused = False
+            self.transport.resumeProducing()
+
+        return bool(self._inbound)
+
+    def _allocate(self, shape):
+        if self.factory.pool:
+            return self.factory.pool.get(shape)
+
+        return np.zeros(shape, dtype=np.uint8)
+
+    def _release(self, buf):
+        if self.factory.pool:
+            self.factory.pool.put(buf)
 
     def vncConnectionMade(self):
-        self.setPixelFormat()
-        self.setEncodings([rfb.RAW_ENCODING, rfb.PSEUDOENC_CURSOR,
-                           rfb.PSEUDOENC_DESKTOP_SIZE])
+        # little endian BGRX matches opencv channel order
+        self.setPixelFormat(redshift=16, greenshift=8, blueshift=0)
+
+        shape = (self.height, self.width, 4)
+        if self.framebuffer is not None and self.framebuffer.shape == shape:
+            self.resumed = True
+        else:
+            if self.framebuffer is not None:
+                self._release(self.framebuffer)
+            self.framebuffer = self._allocate(shape)
+            self.damage.add((0, 0, self.width, self.height))
+
+        encodings = [rfb.ZRLE_ENCODING, rfb.TIGHT_ENCODING]
+        if self.quality_level is not None:
+            # prefer tight so we actually get JPEG
+            encodings.reverse()
+
+        encodings = [rfb.COPY_RECTANGLE_ENCODING] + encodings
+        encodings += [rfb.RAW_ENCODING,
+                      rfb.PSEUDOENC_CURSOR,
+                      rfb.PSEUDOENC_DESKTOP_SIZE,
+                      rfb.PSEUDOENC_EXTENDED_DESKTOP_SIZE,
+                      rfb.PSEUDOENC_CONTINUOUS_UPDATES,
+                      rfb.PSEUDOENC_FENCE]
+
+        if self.quality_level is not None:
+            encodings.append(rfb.PSEUDOENC_QUALITY_LEVEL_0 +
+                             self.quality_level)
+        if self.compress_level is not None:
+            encodings.append(rfb.PSEUDOENC_COMPRESS_LEVEL_0 +
+                             self.compress_level)
+
+        self.setEncodings(encodings)
         self.factory.clientConnectionMade(self)
 
+    def connectionLost(self, reason):
+        if self.recorder:
+            self.recorder.close()
+
+    def setPixelFormat(self, *args, **kwargs):
+        rfb.RFBClient.setPixelFormat(self, *args, **kwargs)
+
+        # byte positions of blue, green and red within a pixel
+        shifts = (self.blueshift, self.greenshift, self.redshift)
+        index = [shift // 8 for shift in shifts]
+        if self.bigendian:
+            index = [self.bypp - 1 - i for i in index]
+
+        self._bgr_index = index
+        self._native = self.bypp == 4 and index == [0, 1, 2]
+        self._colors = {}
+
+    @property
+    def screen(self):
+        """ BGR view of the framebuffer, no copy is made """
+        if self.framebuffer is None:
+            return None
+
+        return self.framebuffer[:, :, :3]
+
+    def composite(self):
+        """ Return BGR copy of the screen with the cursor drawn
+            at the pointer position """
+        img = self.screen.copy()
+        if self.cursor is None:
+            return img
+
+        ch, cw = self.cursor.shape[:2]
+        x = self.x - self.cursor_hotspot[0]
+        y = self.y - self.cursor_hotspot[1]
+
+        # clip the cursor to the screen
+        sx, sy = max(0, -x), max(0, -y)
+        ex = min(cw, img.shape[1] - x)
+        ey = min(ch, img.shape[0] - y)
+        if sx >= ex or sy >= ey:
+            return img
+
+        sprite = self.cursor[sy:ey, sx:ex]
+        area = img[y + sy:y + ey, x + sx:x + ex]
+        opaque = sprite[:, :, 3] > 0
+        area[opaque] = sprite[:, :, :3][opaque]
+        return img
+
     def _decode_key(self, key):
         return [keys.KEYMAP.get(k) or ord(k) for k in key.split('`')]
 
@@ -36,27 +258,27 @@ class VNC(rfb.RFBClient):
             key: string: either [a-z] or a from KEYMAP
         """
         log.msg('key_press {0}'.format(key))
-        self.key_down(key)
-        self.key_up(key)
+        self._key(key, down=1)
+        self._key(key, down=0)
 
         return self
 
     def key_down(self, key):
         log.msg('key_down {0}'.format(key))
-        keys = self._decode_key(key)
-        for k in keys:
-            self.keyEvent(k, down=1)
+        self._key(key, down=1)
 
         return self
 
     def key_up(self, key):
         log.msg('key_up {0}'.format(key))
-        keys = self._decode_key(key)
-        for k in keys:
-            self.keyEvent(k, down=0)
+        self._key(key, down=0)
 
         return self
 
+    def _key(self, key, down):
+        for k in self._decode_key(key):
+            self.keyEvent(k, down=down)
+
     def mouse_press(self, button):
         """ Send a mouse click at the last set position
 
@@ -122,12 +344,108 @@ class VNC(rfb.RFBClient):
 
         return self
 
+    # input batching, events are queued and written at once
+    # in the next reactor iteration
+
+    def keyEvent(self, key, down=1):
+        self._queue_input(False, pack("!BBxxI", 4, down, key))
+
+    def pointerEvent(self, x, y, buttonmask=0):
+        with self._input_lock:
+            move = buttonmask == self._input_mask
+            self._input_mask = buttonmask
+        self._queue_input(move, pack("!BBHH", 5, buttonmask, x, y))
+
+    def clientCutText(self, message):
+        self._queue_input(False, pack("!BxxxI", 6, len(message)) + message)
+
+    def _queue_input(self, move, message):
+        with self._input_lock:
+            if move and self._input and self._input[-1][0]:
+                # only the latest position of consecutive moves matters
+                self._input[-1] = (move, message)
+            else:
+                self._input.append((move, message))
+
+            if not self._input_scheduled:
+                self._input_scheduled = True
+                reactor.callFromThread(self._flush_input)
+
+    def _flush_input(self, force=False):
+        """ Write queued input events, postponed while pointer
+            moves would exceed pointer_rate unless `force`d """
+        with self._input_lock:
+            if self._input_call and self._input_call.active():
+                self._input_call.cancel()
+
+            self._input_scheduled = False
+            if not self._input:
+                return
+
+            now = reactor.seconds()
+            moves = any(move for move, message in self._input)
+            if moves and self.pointer_rate and not force:
+                delay = self._pointer_sent + 1.0 / self.pointer_rate - now
+                if delay > 0:
+                    self._input_scheduled = True
+                    self._input_call = reactor.callLater(delay,
+                                                         self._flush_input)
+                    return
+
+            if moves:
+                self._pointer_sent = now
+
+            data = b''.join(message for move, message in self._input)
+            self._input = []
+
+        self.transport.write(data)
+
+    def flush(self):
+        """ Write queued input now, return Deferred fired once
+            the server processed it """
+        return self.sync()
+
     def bell(self):
         log.msg('VNC bell')
 
+    def copy_text(self, text):
+        self.cut_text = text.decode('latin-1')
+
+        waiters, self._cut_text_waiters = self._cut_text_waiters, []
+        for d in waiters:
+            d.callback(self.cut_text)
+
+    def read_clipboard(self, select=True, timeout=None):
+        """ Copy text of the focused widget, everything if `select`
+            is set, and return Deferred fired with it once the server
+            sends its clipboard, or with None after `timeout` seconds """
+        d = Deferred()
+        self._cut_text_waiters.append(d)
+
+        if timeout is not None:
+            call = reactor.callLater(timeout, self._cut_text_timeout, d)
+            d.addBoth(self._cancel_call, call)
+
+        if select:
+            self.key_press('ctrl`a')
+        self.key_press('ctrl`c')
+
+        return d
+
+    def _cut_text_timeout(self, d):
+        # a later, unrelated ServerCutText must not fire it
+        if d in self._cut_text_waiters:
+            self._cut_text_waiters.remove(d)
+            d.callback(None)
+
+    def _cancel_call(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
+
     def save_screen(self, fpath, screen=None):
         #log.msg('Saving {0}'.format(fpath))
-        if screen:
+        if screen is not None:
             cv2.imwrite(fpath, screen)
         else:
             cv2.imwrite(fpath, self.screen)
@@ -136,39 +454,228 @@ class VNC(rfb.RFBClient):
         if not data:
             return
 
-        # create opencv image and convert colors properly
-        shape = (height, width, 4)
-        img = np.ndarray(shape, dtype=np.uint8, buffer=data)
-        img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
+        img = pixels(data, width, height)
+        if not self._native:
+            img = self._bgr(img)
 
-        if self.screen is None:
-            self.screen = img
+        self._blit(x, y, img)
 
-        ch, cw, d = self.screen.shape
+    def fillRectangle(self, x, y, width, height, color):
+        self.screen[y:y + height, x:x + width] = self._color(color)
 
-        if cw < (x + width) or ch < (y + height):
-            # upward screen resize
-            ncw = max(cw, x + width)
-            nch = max(ch, y + height)
-            nimg = np.ndarray((nch, ncw, d), dtype=np.uint8)
-            nimg[0:ch, 0:cw] = self.screen
-            nimg[y:height, x:width] = img
-            self.screen = nimg
+    def fillRectangles(self, x, y, width, height, colors, rects):
+        bgr = self._bgr(colors)
 
-        elif cw == width and ch == height:
-            self.screen = img
+        if len(rects) * width * height > self.fill_mask_limit:
+            for color, (sx, sy, sw, sh) in zip(bgr, rects):
+                self.screen[sy:sy + sh, sx:sx + sw] = color
+            return
 
-        else:
-            self.screen[y:y + height, x:x + width] = img
+        # index of the last subrect covering each pixel of the area
+        sx, sy, sw, sh = (rects - (x, y, 0, 0)).T
+        xs = np.arange(width)
+        ys = np.arange(height)
+        inx = (xs >= sx[:, None]) & (xs < (sx + sw)[:, None])
+        iny = (ys >= sy[:, None]) & (ys < (sy + sh)[:, None])
+        cover = iny[:, :, None] & inx[:, None, :]
+        last = len(rects) - 1 - np.argmax(cover[::-1], axis=0)
+        hit = cover.any(axis=0)
+
+        area = self.screen[y:y + height, x:x + width]
+        area[hit] = bgr[last[hit]]
+
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        src = self.framebuffer[srcy:srcy + height, srcx:srcx + width]
+        if abs(srcx - x) < width and abs(srcy - y) < height:
+            # overlapping areas (scrolling), copy source first
+            src = src.copy()
+
+        self.framebuffer[y:y + height, x:x + width] = src
+
+    def _bgr(self, pixels):
+        """ Convert (..., bypp) `pixels` in the client pixel format
+            to BGR """
+        return pixels[..., self._bgr_index]
+
+    def _color(self, color):
+        """ Cached BGR value of `color` string in the client
+            pixel format """
+        bgr = self._colors.get(color)
+        if bgr is None:
+            if len(self._colors) > 4096:
+                self._colors.clear()
+
+            bgr = self._bgr(np.frombuffer(color, dtype=np.uint8))
+            self._colors[color] = bgr
+
+        return bgr
+
+    def updateCursor(self, x, y, width, height, image, mask):
+        if not width or not height:
+            # invisible cursor
+            self.cursor = None
+            return
+
+        img = pixels(image, width, height)
+        row = (width + 7) // 8
+        bits = np.unpackbits(np.asarray(mask).reshape((height, row)),
+                             axis=1)[:, :width]
+
+        cursor = np.empty((height, width, 4), dtype=np.uint8)
+        cursor[:, :, :3] = self._bgr(img)
+        cursor[:, :, 3] = bits * 255
+        self.cursor = cursor
+        self.cursor_hotspot = (x, y)
+
+    def jpegRectangle(self, x, y, width, height, data):
+        img = cv2.imdecode(np.asarray(data), cv2.IMREAD_COLOR)
+        if img is None:
+            log.msg('Unable to decode JPEG rectangle')
+            return
+
+        self._blit(x, y, img)
+
+    def _blit(self, x, y, img):
+        """ Copy BGR or BGRX `img` to the framebuffer at (x, y) """
+        height, width, depth = img.shape
+        self.framebuffer[y:y + height, x:x + width, :depth] = img
+
+    def desktopResized(self, width, height):
+        log.msg('VNC desktop resized to {0}x{1}'.format(width, height))
+
+        # keep what still fits, server repaints the rest
+        fb = self._allocate((height, width, 4))
+        ch = min(height, self.framebuffer.shape[0])
+        cw = min(width, self.framebuffer.shape[1])
+        fb[:ch, :cw] = self.framebuffer[:ch, :cw]
+        self._release(self.framebuffer)
+        self.framebuffer = fb
+
+        self.damage.take()
+        self.damage.add((0, 0, width, height))
+
+        # requested areas were clipped to the old size
+        if self.continuous_updates:
+            self.enableContinuousUpdates()
+        elif not self.updates_paused:
+            self.framebufferUpdateRequest(incremental=0)
+
+        self.factory.clientResized(self)
 
     def commitUpdate(self, rectangles=None):
-        if self.deferred:
-            d = self.deferred
-            self.deferred = None
-            # callback one second later so we catch all the changes
-            # caused by our last action. If we callback instantly
-            # we get in-transition screenshot which is not what we want
-            reactor.callLater(4, d.callback, self)
+        self.damage.extend(rectangles or [])
+        self.settle.update(rectangles or [])
+
+        if not (self.continuous_updates or self.updates_paused):
+            self.framebufferUpdateRequest(incremental=1)
+
+        if not self._synced:
+            self._synced = True
+            self.factory.clientSynced(self)
+
+        # response to sync request covers the origin, updates which
+        # were already on the way when it was sent usually don't
+        if self._sync_waiters and any(x == 0 and y == 0 for
+                                      (x, y, w, h) in rectangles or []):
+            d = self._sync_waiters.pop(0)
+            if d is not None:
+                d.callback(self)
+
+    def wait_settled(self):
+        """ Return Deferred fired with self once the screen settles
+            after a change.
+
+            We want to catch all the changes caused by our last action,
+            firing on the first update would give us in-transition
+            screenshot which is not what we want.
+        """
+        d = self.settle.wait()
+        d.addCallback(lambda _: self)
+        return d
+
+    def endOfContinuousUpdates(self):
+        if not self.continuous_updates_supported:
+            log.msg('VNC server supports continuous updates')
+            self.continuous_updates_supported = True
+            self.enableContinuousUpdates()
+            self.continuous_updates = True
+        elif self.updates_paused:
+            self.continuous_updates = False
+
+    def pause_updates(self):
+        """ Stop receiving framebuffer updates, server accumulates
+            the changes meanwhile """
+        if self.updates_paused:
+            return
+
+        log.msg('VNC updates paused')
+        self.updates_paused = True
+        if self.continuous_updates:
+            self.enableContinuousUpdates(0)
+
+    def resume_updates(self):
+        """ Receive updates again, starting with changes
+            accumulated while paused """
+        if not self.updates_paused:
+            return
+
+        log.msg('VNC updates resumed')
+        self.updates_paused = False
+        if self.continuous_updates_supported:
+            self.enableContinuousUpdates()
+            self.continuous_updates = True
+        else:
+            self.framebufferUpdateRequest(incremental=1)
+
+    def fenceReceived(self, flags, payload):
+        if flags & rfb.FENCE_REQUEST:
+            # servers announce fence support by sending a request
+            self.fences_supported = True
+            return
+
+        d = self._fences.pop(payload, None)
+        if d:
+            d.callback(self)
+
+    def sync(self, timeout=None):
+        """ Return Deferred fired with self once the server processed
+            all messages sent so far, or with None after `timeout`
+            seconds.
+
+            Uses fence round trip if supported, small non-incremental
+            framebuffer update request of the origin otherwise, each
+            update touching the origin answers the oldest request.
+        """
+        d = Deferred()
+        # queued input has to reach the server first
+        self._flush_input(force=True)
+
+        payload = None
+        if self.fences_supported:
+            self._fence_id += 1
+            payload = pack("!I", self._fence_id)
+            self._fences[payload] = d
+            self.fence(rfb.FENCE_REQUEST | rfb.FENCE_BLOCK_BEFORE, payload)
+        else:
+            self._sync_waiters.append(d)
+            self.framebufferUpdateRequest(0, 0, 1, 1)
+
+        if timeout is not None:
+            call = reactor.callLater(timeout, self._sync_timeout, d, payload)
+            d.addBoth(self._cancel_call, call)
+
+        return d
+
+    def _sync_timeout(self, d, payload):
+        if payload is not None:
+            if self._fences.get(payload) is d:
+                del self._fences[payload]
+                d.callback(None)
+        elif d in self._sync_waiters:
+            # the response may still come, keep its place in the queue
+            # so that it doesn't answer a later request
+            self._sync_waiters[self._sync_waiters.index(d)] = None
+            d.callback(None)
 
 
 class VNCFactory(ReconnectingClientFactory):
@@ -176,22 +683,84 @@ class VNCFactory(ReconnectingClientFactory):
 
     protocol = VNC
 
+    # set when managed by hub.VNCHub
+    hub = None
+    pool = None
+    decode_budget = None
+
     def __init__(self, shared=0):
         self.shared = shared
         self.deferred = Deferred()
         self.proto = None
         self.connected_callback = None
         self.disconnected_callback = None
+        self.resized_callback = None
+        self.synced_callback = None
+        # FBS recording of the sessions, suffixed by connection number
+        self.record_path = config.get('vnc_record')
+        self.connections = 0
+
+        # reconnect quickly, QEMU drops connections on guest reboots
+        self.initialDelay = 0.1
+        self.maxDelay = 5
+        self.resetDelay()
+        self.connecting_since = None
+        self.lost_at = None
+        self.reconnects = 0
+
+    def startedConnecting(self, connector):
+        if self.connecting_since is None:
+            self.connecting_since = reactor.seconds()
+
+    def buildProtocol(self, addr):
+        protocol = ReconnectingClientFactory.buildProtocol(self, addr)
+        if self.proto:
+            protocol.resume(self.proto)
+
+        if self.record_path:
+            path = '{0}.{1}'.format(self.record_path, self.connections)
+            log.msg('Recording VNC session to {0}'.format(path))
+            protocol.recorder = fbs.FBSWriter(open(path, 'wb'))
+
+        self.connections += 1
+        return protocol
 
     def clientConnectionMade(self, protocol):
         log.msg("VNC connection made")
+        self.resetDelay()
         self.proto = protocol
-        self.proto.framebufferUpdateRequest()
+        # with the framebuffer kept only changes are needed, servers
+        # unaware of our state may still send the whole screen
+        self.proto.framebufferUpdateRequest(incremental=protocol.resumed)
         if self.connected_callback:
             self.connected_callback(protocol)
 
+    def clientSynced(self, protocol):
+        """ First update of the connection arrived """
+        stats = {
+            'reconnect': self.lost_at is not None,
+            'resumed': protocol.resumed,
+            'time': reactor.seconds() - (self.lost_at or
+                                         self.connecting_since),
+            'bytes': protocol.bytes_received,
+        }
+        self.lost_at = None
+        self.connecting_since = None
+
+        log.msg('VNC synced in {time:.3f}s, {bytes} bytes received'
+                .format(**stats))
+        if self.synced_callback:
+            self.synced_callback(protocol, stats)
+
+    def clientResized(self, protocol):
+        if self.resized_callback:
+            self.resized_callback(protocol)
+
     def clientConnectionLost(self, connector, reason):
         log.msg('Lost VNC connection.  Reason: {0}'.format(reason))
+        if self.lost_at is None:
+            self.lost_at = reactor.seconds()
+        self.reconnects += 1
 
         if self.disconnected_callback:
             self.disconnected_callback()
@@ -0,0 +1,158 @@
+"""
+ZRLE (Zlib Run-Length Encoding) decoder.
+
+Works on already decompressed rectangle data, zlib stream
+itself is kept per connection by RFBClient.
+
+Reference:
+http://www.realvnc.com/docs/rfbproto.pdf
+"""
+
+import numpy as np
+
+TILE_SIZE = 64
+
+
+def decode(data, width, height, bypp, cbypp=None, offset=0):
+    """
+    Decode decompressed ZRLE `data` of `width` x `height` rectangle.
+
+    `bypp` is number of bytes per pixel of the client pixel format,
+    `cbypp` is the size of compressed pixel (CPIXEL) which is stored
+    at byte `offset` of the pixel.
+
+    Returns (height, width, bypp) ndarray in the client pixel format.
+    """
+
+    if cbypp is None:
+        cbypp = bypp
+
+    raw = bytearray(data)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    out = np.zeros((height, width, bypp), dtype=np.uint8)
+
+    pos = 0
+    for ty in range(0, height, TILE_SIZE):
+        th = min(TILE_SIZE, height - ty)
+        for tx in range(0, width, TILE_SIZE):
+            tw = min(TILE_SIZE, width - tx)
+            tile = out[ty:ty + th, tx:tx + tw, offset:offset + cbypp]
+            pos = decode_tile(raw, buf, pos, tile, cbypp)
+
+    return out
+
+
+def decode_tile(raw, buf, pos, tile, cbypp):
+    """
+    Decode single tile starting at `pos` into `tile` view.
+
+    `raw` and `buf` are the same data as bytearray and ndarray.
+
+    Returns position of the next tile.
+    """
+
+    th, tw = tile.shape[:2]
+    subencoding = raw[pos]
+    pos += 1
+
+    if subencoding == 0:        # raw
+        size = tw * th * cbypp
+        tile[...] = buf[pos:pos + size].reshape((th, tw, cbypp))
+        pos += size
+
+    elif subencoding == 1:      # solid
+        tile[...] = buf[pos:pos + cbypp]
+        pos += cbypp
+
+    elif subencoding <= 16:     # packed palette
+        palette, pos = read_palette(buf, pos, subencoding, cbypp)
+        if subencoding == 2:
+            bits = 1
+        elif subencoding <= 4:
+            bits = 2
+        else:
+            bits = 4
+
+        row = (tw * bits + 7) // 8
+        size = row * th
+        packed = buf[pos:pos + size].reshape((th, row))
+        tile[...] = palette[unpack_indices(packed, bits, tw)]
+        pos += size
+
+    elif subencoding == 128:    # plain RLE
+        starts = []
+        lengths = []
+        total = tw * th
+        while total > 0:
+            starts.append(pos)
+            length, pos = read_run_length(raw, pos + cbypp)
+            lengths.append(length)
+            total -= length
+
+        idx = np.array(starts)[:, None] + np.arange(cbypp)
+        run = np.repeat(buf[idx], lengths, axis=0)
+        tile[...] = run.reshape((th, tw, cbypp))
+
+    elif subencoding >= 130:    # palette RLE
+        palette, pos = read_palette(buf, pos, subencoding - 128, cbypp)
+        indices = []
+        lengths = []
+        total = tw * th
+        while total > 0:
+            index = raw[pos]
+            pos += 1
+            if index & 128:
+                length, pos = read_run_length(raw, pos)
+            else:
+                length = 1
+
+            indices.append(index & 127)
+            lengths.append(length)
+            total -= length
+
+        run = np.repeat(palette[indices], lengths, axis=0)
+        tile[...] = run.reshape((th, tw, cbypp))
+
+    else:
+        raise ValueError("invalid ZRLE subencoding {0}".format(subencoding))
+
+    return pos
+
+
+def read_palette(buf, pos, size, cbypp):
+    """
+    Read palette of `size` CPIXELs, returns (palette, pos)
+    """
+
+    end = pos + size * cbypp
+    return buf[pos:end].reshape((size, cbypp)), end
+
+
+def read_run_length(raw, pos):
+    """
+    Read run length encoded as sum of bytes terminated by
+    byte != 255, returns (length, pos)
+    """
+
+    length = 1
+    while True:
+        value = raw[pos]
+        pos += 1
+        length += value
+        if value != 255:
+            return length, pos
+
+
+def unpack_indices(packed, bits, width):
+    """
+    Unpack palette indices of `bits` size from `packed` rows
+    padded to byte boundary, returns (rows, width) ndarray
+    """
+
+    unpacked = np.unpackbits(packed, axis=1)
+    if bits > 1:
+        unpacked = unpacked.reshape((packed.shape[0], -1, bits))
+        weights = 1 << np.arange(bits - 1, -1, -1)
+        unpacked = unpacked.dot(weights)
+
+    return unpacked[:, :width]
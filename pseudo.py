@@ -1,6 +1,6 @@
 import time
 
-from pllm.vision.tasks import template_match
+from pllm.vision.tasks import template_match, match_many
 
 PASSWORD = "fedora"
 TIMEOUT = 60000
@@ -41,7 +41,8 @@ class cachefind(object):
 @screenlock
 @cachefind
 def find(dom, template_name):
-    res, x, y = template_match(dom.screen_path, template_name)
+    res, x, y = template_match(dom.screen_path, template_name,
+                               dom.template_scales)
     if res:
         print('+{0}@{1} = {2}'.format(template_name, dom.screen_id, res))
         ret = True
@@ -55,7 +56,8 @@ def find(dom, template_name):
 @screenlock
 @cachefind
 def findxy(dom, template_name):
-    res, x, y = template_match(dom.screen_path, template_name)
+    res, x, y = template_match(dom.screen_path, template_name,
+                               dom.template_scales)
     if res:
         print('+{0}@{1} = {2}'.format(template_name, dom.screen_id, res))
         ret = True
@@ -66,10 +68,39 @@ def findxy(dom, template_name):
     return (ret, x, y)
 
 
+def find_many(dom, template_names):
+    """
+    Find all templates on the current screen in one pass,
+    returns (screen_id, {template_name: found})
+    """
+
+    template_names = sorted(set(template_names), key=template_names.index)
+
+    with dom.screen_lock:
+        screen_id = dom.screen_id
+        results = match_many(dom.screen_path, template_names,
+                             dom.template_scales)
+
+    found = {}
+    for template_name, (res, x, y) in zip(template_names, results):
+        sign = '+' if res else '-'
+        print('{0}{1}@{2} = {3}'.format(sign, template_name, screen_id, res))
+        found[template_name] = res
+
+    return screen_id, found
+
+
 def expect(dom, items):
-    for stage_name, template, callback in items:
+    templates = [template for stage_name, template, callback in items]
+    screen_id, found = find_many(dom, templates)
+
+    for i, (stage_name, template, callback) in enumerate(items):
         print('Testing stage {0}'.format(stage_name))
-        if find(dom, template):
+        if dom.screen_id != screen_id:
+            # callback of a previous stage changed the screen
+            screen_id, found = find_many(dom, templates[i:])
+
+        if found[template]:
             print('Stage "{0}" found'.format(stage_name))
             callback(dom)
 
@@ -93,8 +124,6 @@ def click(dom, template):
     else:
         print('Click target not found')
 
-    time.sleep(0.5)
-
 
 def click_segment(dom, text, exact=False):
     print('Looking for segment with text "{0}"'.format(text))